@@ -7,6 +7,7 @@ Four.meme 早期買家分析器 - Etherscan API V2 專用版
 from flask import Flask, render_template, request, jsonify, Response
 from flask_cors import CORS
 import requests
+from urllib3.util.retry import Retry
 import time
 import csv
 import io
@@ -14,12 +15,39 @@ from datetime import datetime
 from typing import Dict, List
 import json
 import uuid
+import secrets
+import itertools
+import traceback
 import os
+import re
+import sys
+import sqlite3
 from threading import Lock
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque, OrderedDict
+from dataclasses import dataclass
+from contextlib import contextmanager
+from bisect import bisect_left, bisect_right
+import operator
+import weakref
 import queue
 import threading
 
+try:
+    import orjson  # C 實現的 JSON 解析，比標準庫快數倍
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl  # 跨 Worker 的文件鎖（Windows 上沒有，單進程運行時不需要）
+except ImportError:
+    fcntl = None
+
+try:
+    from web3 import Web3  # 只有付費驗證需要，未安裝時其他功能照常運行
+except ImportError:
+    Web3 = None
+
 app = Flask(__name__)
 CORS(app, resources={
     r"/api/*": {
@@ -47,46 +75,205 @@ PAID_API_KEY_POOL = [
 
 # 收款地址
 PAYMENT_RECEIVER = '0xe0b7e35556731872B3CE18c9645D69290F428C1C'
+PAYMENT_RECEIVER_LOWER = PAYMENT_RECEIVER.lower()
 
 # 付費配置
 PAYMENT_AMOUNT_BNB = 0.01  # BNB
+# 允許 ±1% 誤差
+PAYMENT_AMOUNT_BNB_MIN = PAYMENT_AMOUNT_BNB * 0.99
+PAYMENT_AMOUNT_BNB_MAX = PAYMENT_AMOUNT_BNB * 1.01
 PAYMENT_TOKEN_EXPIRY = 3600  # 1 小時（秒）
 PAYMENT_TOKEN_USES = 3  # 3 次使用
 
-# 付費憑證存儲
-PAYMENT_TOKENS_FILE = '/tmp/payment_tokens.json'
-USED_TX_HASHES_FILE = '/tmp/used_tx_hashes.json'
+# 付費憑證存儲（追加式 JSONL 日誌：每次變更追加一行，同一條記錄以最後一行為準）
+PAYMENT_TOKENS_FILE = '/tmp/payment_tokens.jsonl'
+USED_TX_HASHES_FILE = '/tmp/used_tx_hashes.jsonl'
+# 舊版整檔 JSON 存儲，日誌不存在時導入一次
+LEGACY_PAYMENT_TOKENS_FILE = '/tmp/payment_tokens.json'
+LEGACY_USED_TX_HASHES_FILE = '/tmp/used_tx_hashes.json'
+# 日誌行數超過有效記錄數兩倍再加此餘量時，重寫為精簡形式
+LOG_COMPACT_SLACK = 100
 
-def load_payment_tokens():
-    """加載付費憑證"""
+# 已解析的日誌快取：path -> ((mtime_ns, size), data, 行數)
+# 文件未被其他進程改動時直接返回記憶體中的數據，不再每個請求都重新讀取、解析
+log_store_cache = {}
+log_store_lock = Lock()
+
+def get_file_stamp(path):
+    """文件的 (修改時間, 大小)，文件不存在時返回 None"""
     try:
-        with open(PAYMENT_TOKENS_FILE, 'r') as f:
-            return json.load(f)
+        st = os.stat(path)
     except FileNotFoundError:
-        return {}
+        return None
+    return (st.st_mtime_ns, st.st_size)
 
-def save_payment_tokens(tokens):
-    """保存付費憑證"""
-    with open(PAYMENT_TOKENS_FILE, 'w') as f:
-        json.dump(tokens, f)
+def dump_log_line(record):
+    """序列化一條日誌記錄（單行 JSON）"""
+    if orjson:
+        return orjson.dumps(record) + b'\n'
+    return json.dumps(record).encode() + b'\n'
 
-def load_used_tx_hashes():
-    """加載已使用的交易 Hash"""
+def write_log_file(path, records):
+    """原子重寫日誌文件（壓縮、導入時使用，調用方需持有 log_file_lock），返回寫入的行數"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    lines = 0
+    with open(tmp_path, 'wb') as f:
+        for record in records:
+            f.write(dump_log_line(record))
+            lines += 1
+    os.replace(tmp_path, path)
+    return lines
+
+@contextmanager
+def log_file_lock(path):
+    """跨進程的日誌鎖（旁路鎖文件 + flock）：追加、壓縮、導入都在鎖內進行，
+    其他 Worker 的寫入不會在讀取和替換之間丟失"""
+    if fcntl is None:
+        yield
+        return
+    with open(path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def parse_log_file(path, default, apply):
+    """逐行解析日誌，由 apply 合併進數據，返回 (data, 行數)"""
+    data = default()
+    lines = 0
     try:
-        with open(USED_TX_HASHES_FILE, 'r') as f:
-            return json.load(f)
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    record = orjson.loads(line) if orjson else json.loads(line)
+                except ValueError:
+                    continue  # 寫入中斷留下的不完整行
+                apply(data, record)
+                lines += 1
     except FileNotFoundError:
-        return []
+        pass
+    return data, lines
+
+def log_needs_compaction(data, lines):
+    """舊記錄過多（行數超過有效記錄數兩倍再加餘量）時需要重寫"""
+    return lines > 2 * len(data) + LOG_COMPACT_SLACK
+
+def compact_log(path, default, apply, to_records):
+    """持鎖重新讀取並重寫日誌，返回 (data, 行數)；調用方需持有 log_file_lock"""
+    data, lines = parse_log_file(path, default, apply)
+    if log_needs_compaction(data, lines):
+        lines = write_log_file(path, to_records(data))
+        print(f"🗜️ 壓縮日誌: {path} ({lines} 條記錄)")
+    return data, lines
+
+def load_log_store(path, default, apply, to_records):
+    """讀取追加式日誌存儲（按修改時間和大小快取），舊記錄過多時順帶壓縮"""
+    with log_store_lock:
+        # 先取修改時間再讀文件，讀取之後其他進程的追加會讓下次讀取重新解析
+        stamp = get_file_stamp(path)
+        if stamp is None:
+            return default()
+        cached = log_store_cache.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        
+        data, lines = parse_log_file(path, default, apply)
+        if log_needs_compaction(data, lines):
+            with log_file_lock(path):
+                data, lines = compact_log(path, default, apply, to_records)
+                stamp = get_file_stamp(path)
+        log_store_cache[path] = (stamp, data, lines)
+        return data
+
+def append_log_store(path, record, default, apply, to_records, is_new=None):
+    """追加一條記錄（O(1)，不重寫整個文件），返回是否寫入
+    
+    在跨進程鎖內先同步到文件的最新狀態；傳入 is_new 時據此判斷記錄是否仍需寫入（例如交易 Hash 查重）
+    """
+    with log_store_lock, log_file_lock(path):
+        stamp = get_file_stamp(path)
+        cached = log_store_cache.get(path)
+        if cached is not None and cached[0] == stamp:
+            data, lines = cached[1], cached[2]
+        else:
+            # 其他進程寫過，持鎖重新解析
+            data, lines = parse_log_file(path, default, apply)
+        
+        if is_new is not None and not is_new(data, record):
+            log_store_cache[path] = (stamp, data, lines)
+            return False
+        
+        with open(path, 'ab') as f:
+            f.write(dump_log_line(record))
+        apply(data, record)
+        lines += 1
+        
+        if log_needs_compaction(data, lines):
+            data, lines = compact_log(path, default, apply, to_records)
+        log_store_cache[path] = (get_file_stamp(path), data, lines)
+        return True
+
+def import_legacy_store(legacy_path, path, to_records):
+    """把舊版整檔 JSON 存儲導入為日誌（日誌已存在時跳過）"""
+    if not os.path.exists(legacy_path):
+        return
+    try:
+        with log_file_lock(path):
+            if os.path.exists(path):
+                return
+            with open(legacy_path, 'rb') as f:
+                data = json.loads(f.read())
+            lines = write_log_file(path, to_records(data))
+        print(f"📥 已導入舊版存儲: {legacy_path} → {path} ({lines} 條記錄)")
+    except (OSError, ValueError) as e:
+        print(f"⚠️ 導入舊版存儲失敗: {legacy_path}: {e}")
+
+def apply_payment_token_record(tokens, record):
+    tokens[record['token']] = record['data']
 
-def save_used_tx_hashes(hashes):
-    """保存已使用的交易 Hash"""
-    with open(USED_TX_HASHES_FILE, 'w') as f:
-        json.dump(hashes, f)
+def payment_token_records(tokens):
+    return ({'token': token, 'data': token_data} for token, token_data in tokens.items())
+
+def apply_tx_hash_record(hashes, record):
+    hashes.add(record)
+
+def tx_hash_records(hashes):
+    return sorted(hashes)
+
+def load_payment_tokens():
+    """加載付費憑證"""
+    return load_log_store(PAYMENT_TOKENS_FILE, dict, apply_payment_token_record, payment_token_records)
+
+def save_payment_token(payment_token, token_data):
+    """保存單個付費憑證的最新狀態"""
+    append_log_store(PAYMENT_TOKENS_FILE, {'token': payment_token, 'data': token_data},
+                     dict, apply_payment_token_record, payment_token_records)
+
+def load_used_tx_hashes():
+    """加載已使用的交易 Hash（集合，查重 O(1)）"""
+    return load_log_store(USED_TX_HASHES_FILE, set, apply_tx_hash_record, tx_hash_records)
+
+def is_new_tx_hash(hashes, tx_hash):
+    return tx_hash not in hashes
+
+def add_used_tx_hash(tx_hash):
+    """標記交易 Hash 已使用；已被使用過（包括其他 Worker 剛剛標記）時返回 False"""
+    return append_log_store(USED_TX_HASHES_FILE, tx_hash, set, apply_tx_hash_record, tx_hash_records,
+                            is_new=is_new_tx_hash)
+
+import_legacy_store(LEGACY_PAYMENT_TOKENS_FILE, PAYMENT_TOKENS_FILE, payment_token_records)
+import_legacy_store(LEGACY_USED_TX_HASHES_FILE, USED_TX_HASHES_FILE, tx_hash_records)
+
+# 輪詢分配付費 Key：Etherscan 按 Key 限速，輪流使用讓每個 Key 的負載均勻，
+# 每個 Key 各自的速率限制器見 FourMemeAnalyzer._get_rate_limiter
+paid_api_key_cycle = itertools.cycle(PAID_API_KEY_POOL)
+paid_api_key_lock = Lock()
 
 def get_paid_api_key():
-    """隨機獲取一個付費 API Key"""
-    import random
-    return random.choice(PAID_API_KEY_POOL)
+    """輪流獲取一個付費 API Key"""
+    with paid_api_key_lock:
+        return next(paid_api_key_cycle)
 
 # ==================== Session 管理繼續 ====================
 
@@ -95,40 +282,51 @@ def get_paid_api_key():
 # 最大並發分析數
 MAX_CONCURRENT_ANALYSIS = 4  # 根據 Render 資源使用率調整：512MB 可支援 4-6 個並發
 
+# 最大排隊數：排滿後直接拒絕新請求，避免積壓的任務撐爆記憶體
+MAX_QUEUE_LENGTH = 5
+
+# 排隊已滿時建議客戶端多久後重試（秒）
+QUEUE_FULL_RETRY_AFTER = 60
+
 # 線程池
-analysis_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_ANALYSIS)
+analysis_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_ANALYSIS, thread_name_prefix='analyze')
 
 # 活躍任務追蹤
-active_tasks = []  # 存儲 {session_id, start_time, token_address}
+active_tasks = {}  # session_id -> {session_id, start_time, token_address}
 active_tasks_lock = threading.Lock()
 
 # 排隊系統
-analysis_queue_data = []  # 存儲 {session_id, queued_at, position}
+analysis_queue_data = {}  # session_id -> {session_id, queued_at}，按加入順序排列，位置即順序
 queue_lock = threading.Lock()
 
 def get_system_status():
     """獲取系統狀態"""
+    # 鎖內只複製列表，構建返回數據放在鎖外，不阻塞任務的加入和移除
     with active_tasks_lock:
-        active_count = len(active_tasks)
-        active_list = [
-            {
-                'session_id': task['session_id'],
-                'token': task['token_address'][:10] + '...',
-                'elapsed': int(time.time() - task['start_time'])
-            }
-            for task in active_tasks
-        ]
-    
+        active_snapshot = list(active_tasks.values())
     with queue_lock:
-        queue_count = len(analysis_queue_data)
-        queue_list = [
-            {
-                'session_id': q['session_id'],
-                'position': q['position'],
-                'wait_time': int(time.time() - q['queued_at'])
-            }
-            for q in analysis_queue_data
-        ]
+        queue_snapshot = list(analysis_queue_data.values())
+    
+    now = time.time()
+    active_count = len(active_snapshot)
+    active_list = [
+        {
+            'session_id': task['session_id'],
+            'token': task['token_address'][:10] + '...',
+            'elapsed': int(now - task['start_time'])
+        }
+        for task in active_snapshot
+    ]
+    
+    queue_count = len(queue_snapshot)
+    queue_list = [
+        {
+            'session_id': q['session_id'],
+            'position': position,
+            'wait_time': int(now - q['queued_at'])
+        }
+        for position, q in enumerate(queue_snapshot, 1)
+    ]
     
     return {
         'active_count': active_count,
@@ -141,56 +339,164 @@ def get_system_status():
         'is_busy': active_count >= MAX_CONCURRENT_ANALYSIS  # 是否繁忙
     }
 
+# 狀態接口的快取時間（秒）：前端輪詢時短時間內的請求共用同一份快照
+SYSTEM_STATUS_CACHE_TTL = 0.5
+# (monotonic 時間, status)
+system_status_cache = (0.0, None)
+system_status_lock = Lock()
+
+def get_cached_system_status():
+    """獲取系統狀態（最多 SYSTEM_STATUS_CACHE_TTL 秒前的快照，只在過期時重新構建）"""
+    global system_status_cache
+    cached_at, status = system_status_cache
+    if status is not None and time.monotonic() - cached_at < SYSTEM_STATUS_CACHE_TTL:
+        return status
+    
+    with system_status_lock:
+        # 等鎖期間可能已被其他線程刷新
+        cached_at, status = system_status_cache
+        if status is None or time.monotonic() - cached_at >= SYSTEM_STATUS_CACHE_TTL:
+            status = get_system_status()
+            system_status_cache = (time.monotonic(), status)
+        return status
+
 def add_active_task(session_id, token_address):
     """添加活躍任務"""
     with active_tasks_lock:
-        active_tasks.append({
+        active_tasks[session_id] = {
             'session_id': session_id,
             'token_address': token_address,
             'start_time': time.time()
-        })
+        }
         print(f"✅ 添加活躍任務: {session_id}, 當前活躍: {len(active_tasks)}")
 
 def remove_active_task(session_id):
     """移除活躍任務"""
     with active_tasks_lock:
-        active_tasks[:] = [t for t in active_tasks if t['session_id'] != session_id]
+        active_tasks.pop(session_id, None)
         print(f"✅ 移除活躍任務: {session_id}, 剩餘活躍: {len(active_tasks)}")
 
 def add_to_queue(session_id):
-    """添加到排隊"""
+    """添加到排隊，返回排隊位置；排隊已滿時返回 None"""
     with queue_lock:
-        position = len(analysis_queue_data) + 1
-        analysis_queue_data.append({
+        if len(analysis_queue_data) >= MAX_QUEUE_LENGTH:
+            return None
+        analysis_queue_data[session_id] = {
             'session_id': session_id,
-            'position': position,
             'queued_at': time.time()
-        })
+        }
+        position = len(analysis_queue_data)
         print(f"📥 添加到排隊: {session_id}, 位置: {position}")
         return position
 
 def remove_from_queue(session_id):
     """從排隊移除"""
     with queue_lock:
-        analysis_queue_data[:] = [q for q in analysis_queue_data if q['session_id'] != session_id]
-        # 重新計算位置
-        for i, q in enumerate(analysis_queue_data):
-            q['position'] = i + 1
+        # 位置由順序決定，移除後不需要重新計算
+        analysis_queue_data.pop(session_id, None)
 
 def can_start_analysis():
-    """檢查是否可以開始分析"""
+    """檢查是否可以開始分析（已有排隊任務時新任務也要排在後面）"""
+    with queue_lock:
+        if analysis_queue_data:
+            return False
     with active_tasks_lock:
         return len(active_tasks) < MAX_CONCURRENT_ANALYSIS
 
 # ==================== Session 管理繼續 ====================
 
+# Session 寫入鎖：按 session_id 分段，不同 session 的更新互不阻塞
+SESSION_LOCK_STRIPES = 16
+session_locks = [Lock() for _ in range(SESSION_LOCK_STRIPES)]
+
+def get_session_lock(session_id):
+    """獲取 session 對應的分段鎖"""
+    return session_locks[hash(session_id) % SESSION_LOCK_STRIPES]
+
+# 長輪詢的喚醒事件：只在有請求等待時存在（弱引用，等待者都返回後自動回收）
+session_events = weakref.WeakValueDictionary()
+session_events_lock = Lock()
+PROGRESS_LONG_POLL_MAX = 15  # 單次長輪詢最多等待秒數
+
+def get_session_event(session_id):
+    """獲取 session 的喚醒事件（沒有則創建）"""
+    with session_events_lock:
+        event = session_events.get(session_id)
+        if event is None:
+            event = session_events[session_id] = threading.Event()
+        return event
+
+def notify_session_change(session_id):
+    """喚醒等待這個 session 的長輪詢請求，之後的等待者使用新的事件"""
+    with session_events_lock:
+        event = session_events.pop(session_id, None)
+    if event is not None:
+        event.set()
+
+def get_session_mtime(session_id):
+    """獲取 session 文件的修改時間（納秒），不存在返回 None"""
+    try:
+        return os.stat(get_session_path(session_id)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def wait_for_session_change(session_id, event, mtime, timeout):
+    """等待 session 有新的寫入：同進程的寫入由事件立即喚醒，其他 Worker 的寫入靠文件修改時間發現"""
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        if event.wait(min(remaining, 0.5)):
+            return
+        if get_session_mtime(session_id) != mtime:
+            return
+
 def get_session_path(session_id):
     """獲取 session 文件路徑"""
     return os.path.join(SESSION_DIR, f"{session_id}.json")
 
+def json_default(obj):
+    """json.dump 的擴展：BuyerRecord 等結果對象轉為字典"""
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def write_session_file(session_id, session):
+    """原子寫入 session 文件（先寫臨時文件再替換，讀取方永遠看到完整的快照）"""
+    session_path = get_session_path(session_id)
+    tmp_path = f"{session_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if orjson:
+        # 完成時的結果可能包含上千個買家，orjson 直接輸出 bytes，比 json.dump 快數倍
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(session, default=json_default))
+    else:
+        with open(tmp_path, 'w') as f:
+            json.dump(session, f, default=json_default)
+    os.replace(tmp_path, session_path)
+
+# 本進程發起的分析會話的權威副本：進度更新直接修改記憶體中的字典再寫文件，
+# 不必每次先讀回並解析文件；文件仍是給其他 Workers 和輪詢接口讀取的快照
+local_sessions = {}
+
+def load_session_for_update(session_id):
+    """獲取要修改的 session（優先用本進程的副本，沒有才讀文件），調用方需持有 session 鎖"""
+    session = local_sessions.get(session_id)
+    if session is None:
+        session = get_session(session_id)
+    return session
+
+def prune_local_sessions(current_time):
+    """清理沒有走到完成的本進程副本（超過 1 小時，例如分析線程異常退出）"""
+    for session_id, session in list(local_sessions.items()):
+        if current_time - session['created_at'] > 3600:
+            local_sessions.pop(session_id, None)
+
 def create_analysis_session():
     """創建新的分析會話（文件存儲）"""
-    session_id = str(uuid.uuid4())
+    # 每次創建時順帶清理，不依賴 /health 被調用
+    prune_local_sessions(time.time())
+    session_id = uuid.uuid4().hex
     session_data = {
         'status': 'processing',
         'stage': '初始化',
@@ -203,143 +509,586 @@ def create_analysis_session():
         'created_at': time.time()
     }
     
-    with open(get_session_path(session_id), 'w') as f:
-        json.dump(session_data, f)
+    write_session_file(session_id, session_data)
+    local_sessions[session_id] = session_data
     
     print(f"✅ Session 創建（文件）: {session_id}")
     return session_id
 
 def get_session(session_id):
-    """從文件讀取 session"""
+    """從文件讀取 session（輪詢接口每次請求都會讀，有 orjson 時直接解析 bytes）"""
     try:
-        with open(get_session_path(session_id), 'r') as f:
-            return json.load(f)
+        with open(get_session_path(session_id), 'rb') as f:
+            content = f.read()
     except FileNotFoundError:
         return None
+    return orjson.loads(content) if orjson else json.loads(content)
 
 def update_session_progress(session_id, stage='', progress=0, message='', total=0, completed=0):
     """更新 session 進度（文件存儲）"""
-    session_path = get_session_path(session_id)
-    
+    with get_session_lock(session_id):
+        session = load_session_for_update(session_id)
+        if session is None:
+            return
+        
+        if stage:
+            session['stage'] = stage
+        if progress >= 0:
+            session['progress'] = progress
+        if message:
+            session['message'] = message
+        if total > 0:
+            session['total'] = total
+        if completed >= 0:
+            session['completed'] = completed
+        
+        if session['start_time'] > 0 and progress > 5 and progress < 95:
+            elapsed = time.time() - session['start_time']
+            total_estimated = elapsed / (progress / 100)
+            remaining = total_estimated - elapsed
+            # 限制最小值，避免顯示負數或太小的數字
+            session['estimated_time'] = max(5, int(remaining))
+        else:
+            session['estimated_time'] = 0
+        
+        write_session_file(session_id, session)
+    notify_session_change(session_id)
+
+def count_sessions():
+    """統計現存的 session 文件數（所有 Workers 共用同一目錄）"""
     try:
-        with open(session_path, 'r') as f:
-            session = json.load(f)
+        return sum(1 for filename in os.listdir(SESSION_DIR) if filename.endswith('.json'))
     except FileNotFoundError:
-        return
-    
-    if stage:
-        session['stage'] = stage
-    if progress >= 0:
-        session['progress'] = progress
-    if message:
-        session['message'] = message
-    if total > 0:
-        session['total'] = total
-    if completed >= 0:
-        session['completed'] = completed
-    
-    if session['start_time'] > 0 and progress > 5 and progress < 95:
-        elapsed = time.time() - session['start_time']
-        total_estimated = elapsed / (progress / 100)
-        remaining = total_estimated - elapsed
-        # 限制最小值，避免顯示負數或太小的數字
-        session['estimated_time'] = max(5, int(remaining))
-    else:
-        session['estimated_time'] = 0
-    
-    with open(session_path, 'w') as f:
-        json.dump(session, f)
+        return 0
 
 def cleanup_old_sessions():
-    """清理超過 1 小時的舊會話文件"""
+    """清理超過 1 小時沒有更新的舊會話文件（按文件修改時間判斷，不必打開解析）"""
     with cleanup_lock:
         current_time = time.time()
-        for filename in os.listdir(SESSION_DIR):
-            if filename.endswith('.json'):
-                filepath = os.path.join(SESSION_DIR, filename)
+        with os.scandir(SESSION_DIR) as entries:
+            for entry in entries:
+                # 也清理寫入中途崩潰留下的臨時文件
+                if not entry.name.endswith(('.json', '.tmp')):
+                    continue
                 try:
-                    with open(filepath, 'r') as f:
-                        session = json.load(f)
-                    if current_time - session['created_at'] > 3600:
-                        os.remove(filepath)
-                        print(f"🗑️ 清理舊 session: {filename}")
-                except:
+                    if current_time - entry.stat().st_mtime > 3600:
+                        os.remove(entry.path)
+                        print(f"🗑️ 清理舊 session: {entry.name}")
+                except OSError:
                     pass
+        
+        prune_local_sessions(current_time)
 
 def complete_session(session_id, status='completed', result=None):
     """標記會話為完成或錯誤（文件存儲）"""
-    session_path = get_session_path(session_id)
-    
-    try:
-        with open(session_path, 'r') as f:
-            session = json.load(f)
+    with get_session_lock(session_id):
+        # 完成後不會再更新，副本不再保留
+        session = local_sessions.pop(session_id, None) or get_session(session_id)
+        if session is None:
+            print(f"⚠️ Session 不存在: {session_id}")
+            return
         
         session['status'] = status
         session['progress'] = 100
         if result:
             session['result'] = result
         
-        with open(session_path, 'w') as f:
-            json.dump(session, f)
-        print(f"✅ Session 完成: {session_id}, status: {status}")
+        write_session_file(session_id, session)
+    notify_session_change(session_id)
+    print(f"✅ Session 完成: {session_id}, status: {status}")
+# ==================== 進度追蹤結束 ====================
+
+# ==================== 分析結果快取（文件存儲，支援多 Workers）====================
+RESULT_CACHE_DIR = '/tmp/analysis_cache'
+os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+RESULT_CACHE_TTL = 300  # 同一代幣同一區間 5 分鐘內直接返回快取結果
+RESULT_LOCK_STALE = 120  # 鎖文件超過 2 分鐘沒有刷新視為殘留（Worker 崩潰），可以搶佔
+RESULT_LOCK_REFRESH = 15  # 持有者刷新鎖文件修改時間的間隔（秒）
+RESULT_MEMORY_CACHE_SIZE = 32  # 進程內保留最近的結果數，命中時不必讀取、解析快取文件
+
+# 進程內結果快取：cache_path -> (寫入時間, result)，按最近使用排序
+result_memory_cache = OrderedDict()
+result_memory_lock = Lock()
+
+# 本進程持有的結果鎖：session_id -> 心跳線程的停止事件
+held_result_locks = {}
+
+def get_result_cache_path(token_address, start_seconds, end_seconds, max_txs):
+    """獲取分析結果快取文件路徑（按代幣、區間、機器人閾值區分）"""
+    return os.path.join(RESULT_CACHE_DIR, f"{token_address.lower()}_{start_seconds}_{end_seconds}_{max_txs}.json")
+
+def load_cached_result(cache_path):
+    """讀取未過期的快取結果，沒有則返回 None（先查進程內快取，再查文件）"""
+    with result_memory_lock:
+        cached = result_memory_cache.get(cache_path)
+        if cached is not None:
+            if time.time() - cached[0] <= RESULT_CACHE_TTL:
+                result_memory_cache.move_to_end(cache_path)
+                return cached[1]
+            del result_memory_cache[cache_path]
+    
+    try:
+        if time.time() - os.path.getmtime(cache_path) > RESULT_CACHE_TTL:
+            return None
+        with open(cache_path, 'rb') as f:
+            content = f.read()
+        return orjson.loads(content) if orjson else json.loads(content)
+    except (OSError, ValueError):
+        return None
+
+def save_cached_result(cache_path, result):
+    """原子寫入快取結果（同時放入進程內快取）"""
+    with result_memory_lock:
+        result_memory_cache[cache_path] = (time.time(), result)
+        result_memory_cache.move_to_end(cache_path)
+        while len(result_memory_cache) > RESULT_MEMORY_CACHE_SIZE:
+            result_memory_cache.popitem(last=False)
+    
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        if orjson:
+            with open(tmp_path, 'wb') as f:
+                f.write(orjson.dumps(result, default=json_default))
+        else:
+            with open(tmp_path, 'w') as f:
+                json.dump(result, f, default=json_default)
+        os.replace(tmp_path, cache_path)
+    except (OSError, TypeError) as e:
+        print(f"⚠️ 寫入結果快取失敗: {e}")
+
+def keep_result_lock_alive(lock_path, stop_event):
+    """持有者的心跳：定時刷新鎖文件的修改時間（翻頁抓取等沒有進度更新的階段也不中斷），
+    其他請求據此判斷持有者仍在運行"""
+    while not stop_event.wait(RESULT_LOCK_REFRESH):
+        try:
+            os.utime(lock_path)
+        except OSError:
+            return
+
+def remove_stale_result_lock(lock_path):
+    """移除超過 RESULT_LOCK_STALE 沒有刷新的鎖（持有者已崩潰）"""
+    try:
+        if time.time() - os.path.getmtime(lock_path) <= RESULT_LOCK_STALE:
+            return
+        # 先改名再確認：檢查和刪除之間鎖若被其他請求重新創建，不會誤刪新鎖
+        stale_path = f"{lock_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.rename(lock_path, stale_path)
+        if time.time() - os.path.getmtime(stale_path) <= RESULT_LOCK_STALE:
+            try:
+                os.link(stale_path, lock_path)
+            except FileExistsError:
+                pass
+        else:
+            print(f"🗑️ 清理殘留的結果鎖: {lock_path}")
+        os.remove(stale_path)
+    except OSError:
+        pass
+
+def acquire_result_lock(cache_path, session_id):
+    """搶佔同一分析的計算權（O_EXCL 創建鎖文件，跨 Workers 有效），成功返回 True
+    
+    鎖文件內容是持有者的 session_id，持有期間由心跳線程保持修改時間新鮮
+    """
+    lock_path = cache_path + '.lock'
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        remove_stale_result_lock(lock_path)
+        return False
+    try:
+        os.write(fd, session_id.encode())
+    finally:
+        os.close(fd)
+    
+    stop_event = threading.Event()
+    held_result_locks[session_id] = stop_event
+    threading.Thread(target=keep_result_lock_alive, args=(lock_path, stop_event), daemon=True).start()
+    return True
+
+def release_result_lock(cache_path, session_id):
+    """釋放計算權：停止心跳，鎖文件仍屬於本會話時才刪除（殘留後被他人搶佔的鎖不動）"""
+    stop_event = held_result_locks.pop(session_id, None)
+    if stop_event is not None:
+        stop_event.set()
+    lock_path = cache_path + '.lock'
+    try:
+        with open(lock_path, 'rb') as f:
+            owner = f.read().decode(errors='replace')
+        if owner == session_id:
+            os.remove(lock_path)
     except FileNotFoundError:
-        print(f"⚠️ Session 不存在: {session_id}")
         pass
-# ==================== 進度追蹤結束 ====================
+
+def cleanup_result_cache():
+    """清理過期的結果快取、殘留的鎖文件和臨時文件（按文件修改時間判斷）"""
+    with cleanup_lock:
+        current_time = time.time()
+        try:
+            entries = os.scandir(RESULT_CACHE_DIR)
+        except FileNotFoundError:
+            return
+        with entries:
+            for entry in entries:
+                if entry.name.endswith('.json'):
+                    max_age = RESULT_CACHE_TTL
+                elif entry.name.endswith('.lock'):
+                    max_age = RESULT_LOCK_STALE
+                elif entry.name.endswith('.tmp'):
+                    max_age = 3600
+                else:
+                    continue
+                try:
+                    if current_time - entry.stat().st_mtime > max_age:
+                        os.remove(entry.path)
+                        print(f"🗑️ 清理結果快取: {entry.name}")
+                except OSError:
+                    pass
+
+# 輸入格式校驗：在派發分析 / 調用 RPC 之前就拒絕無效輸入
+TOKEN_RE = re.compile(r'0x[0-9a-fA-F]{40}')
+TX_HASH_RE = re.compile(r'0x[0-9a-fA-F]{64}')
+API_KEY_RE = re.compile(r'[0-9A-Za-z]{16,64}')
 
 # 排除的系統地址
-EXCLUDE_ADDRESSES = {
+EXCLUDE_ADDRESSES = frozenset(sys.intern(addr) for addr in (
     "0x0000000000000000000000000000000000000000",
     "0x000000000000000000000000000000000000dead",
-}
+))
+
+# ==================== Etherscan 速率限制 ====================
+
+# 每個 API Key 每秒最多請求數（付費版限制，換了套餐可用環境變量調整）
+ETHERSCAN_MAX_CALLS_PER_SECOND = int(os.environ.get('ETHERSCAN_MAX_CALLS_PER_SECOND', 5))
+
+# 按 API Key 保存的速率限制器、請求地址最多保留的 Key 數（Key 由用戶提供，按最近使用淘汰）
+API_KEY_CACHE_SIZE = 64
+
+# tokentx 每頁最多返回的交易數（Etherscan 上限）
+TRANSFER_PAGE_SIZE = 10000
+
+# 交易超過一頁時，剩餘區塊切成幾段並發翻頁
+TRANSFER_FETCH_PARTITIONS = 4
+
+# tokentx 單頁失敗（限速、網路錯誤）時的重試次數；仍失敗則整個分析失敗，不使用中間缺頁的交易列表
+TRANSFER_PAGE_RETRIES = 3
+
+# BSC 節點 JSON-RPC（支援批量請求）：主交易數據從這裡批量獲取，不佔 Etherscan 額度
+BSC_RPC_URL = os.environ.get('BSC_RPC_URL', 'https://bsc-dataseed.binance.org/')
+
+# 每個 JSON-RPC 批量請求包含的交易數（公共 bsc-dataseed 節點會拒絕或限流更大的批量）
+TX_BATCH_SIZE = 10
+
+# BNB 流動查詢的並發線程數：請求延遲通常遠大於 1/速率，線程數要多於每秒請求數才能把額度用滿
+BNB_LOOKUP_WORKERS = int(os.environ.get('BNB_LOOKUP_WORKERS', 10))
+
+# 查詢階段寫入進度的間隔（秒）
+PROGRESS_UPDATE_INTERVAL = 1.0
+
+# 交易 BNB 流動的記憶體快取上限（筆）：每筆約數百字節，更早的記錄由 SQLite 快取兜底，
+# 記憶體裡只保留最近的一部分，512 MB 實例上不會隨運行時間一直膨脹
+TX_FLOW_CACHE_SIZE = 20_000
+
+# 交易 BNB 流動的磁碟快取（SQLite，跨重啟、跨 Workers 共用）
+TX_CACHE_DB = '/tmp/tx_cache.db'
+
+# BNB 價格快取時間（秒）；價格 API 失敗時最多沿用舊價格的時間（秒）
+BNB_PRICE_TTL = 30
+BNB_PRICE_STALE_TTL = 300
+# 價格 API 全部失敗後，多久之內不再重新請求（秒）：故障期間每個分析不必都再等一輪超時
+BNB_PRICE_FAILURE_TTL = 60
+# 價格 API 的 (連接, 讀取) 超時（秒）；價格接口不重試，失敗直接換下一個來源
+BNB_PRICE_TIMEOUT = (3, 5)
+
+
+class RateLimiter:
+    """滑動窗口速率限制器：任意 period 秒內最多 max_calls 次請求"""
+    
+    def __init__(self, max_calls: int, period: float = 1.0):
+        self.max_calls = max_calls
+        self.period = period
+        self.calls = deque()
+        self.lock = Lock()
+    
+    def acquire(self):
+        """阻塞直到可以發出下一次請求"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.calls and now - self.calls[0] >= self.period:
+                    self.calls.popleft()
+                if len(self.calls) < self.max_calls:
+                    self.calls.append(now)
+                    return
+                wait = self.period - (now - self.calls[0])
+            time.sleep(wait)
+
+
+@dataclass(slots=True)
+class BuyerRecord:
+    """單個區間買家的分析結果（slots 存儲，比字典省記憶體；序列化時才轉成字典）"""
+    address: str
+    first_buy_time: str
+    buy_amount: float
+    sell_amount: float
+    holding: float
+    sell_ratio: float
+    status: str
+    buy_count: int
+    sell_count: int
+    holding_time: str
+    holding_duration_seconds: int
+    buy_value_usd: float
+    sell_value_usd: float
+    holding_value_usd: float
+    total_profit_usd: float
+    profit_multiple: float
+    bnb_spent: float
+    bnb_received: float
+    bnb_profit: float
+    is_bot: bool
+    
+    def to_dict(self) -> dict:
+        """轉為 JSON 字典（字段順序與定義一致）"""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def create_http_session():
+    """創建共用的 HTTP Session（keep-alive 連接池 + 暫時性錯誤自動重試）"""
+    session = requests.Session()
+    retry = Retry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({'GET', 'POST'}),  # 這裡的 POST 都是只讀的 JSON-RPC 查詢
+        raise_on_status=False
+    )
+    # Etherscan 按 Key 限速：適配器內部的重發不經過 RateLimiter，遇到 429 再重發只會超出額度，
+    # 所以只重試連接失敗（請求沒有送達，不佔額度），不按狀態碼或讀取超時重試
+    etherscan_retry = Retry(
+        total=3,
+        connect=3,
+        read=0,
+        status=0,
+        backoff_factor=0.2,
+        allowed_methods=frozenset({'GET'})
+    )
+    # 連接池大小要覆蓋所有並發查詢線程，否則多出的連接用完即丟，每次都要重新握手 TLS
+    pool_maxsize = BNB_LOOKUP_WORKERS * MAX_CONCURRENT_ANALYSIS
+    session.mount('https://', requests.adapters.HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=pool_maxsize,
+        max_retries=retry
+    ))
+    session.mount('https://api.etherscan.io/', requests.adapters.HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=pool_maxsize,
+        max_retries=etherscan_retry
+    ))
+    # 價格接口在持有價格鎖時調用，重試會讓所有並發分析一起等待；失敗直接換下一個來源
+    for price_host in ('https://api.binance.com/', 'https://api.coingecko.com/'):
+        session.mount(price_host, requests.adapters.HTTPAdapter(pool_connections=1, max_retries=0))
+    return session
+
+# 全進程共用一個連接池：Etherscan、BSC 節點、價格接口的連接在所有分析之間複用
+http_session = create_http_session()
 
 
 class FourMemeAnalyzer:
     def __init__(self):
-        self.session = requests.Session()
+        self.session = http_session
+        # 每個 API Key 一個速率限制器（Etherscan 按 Key 限速）
+        self._rate_limiters = OrderedDict()
+        # 每個 API Key 的請求地址（chainid 和 apikey 已編碼進 URL）
+        self._api_base_urls = OrderedDict()
+        self._api_key_cache_lock = Lock()
+        # 交易 BNB 流動快取：tx_hash -> flows（鏈上數據不可變，跨買家、跨分析共用）
+        self._tx_flow_cache = {}
+        self._tx_flow_lock = Lock()
+        self._tx_db = self._open_tx_db()
+        self._tx_db_lock = Lock()
+        # BNB 價格快取：(price, monotonic 時間)
+        self._bnb_price_cache = (0.0, 0.0)
+        # 最近一次價格獲取全部失敗的 monotonic 時間
+        self._bnb_price_failed_at = None
+        self._bnb_price_lock = Lock()
     
-    def _get_bnb_amount_from_tx(self, api_key: str, tx_hash: str, address: str) -> dict:
-        """從交易 hash 獲取該地址的 BNB 流入/流出"""
+    def _open_tx_db(self):
+        """打開交易流動的 SQLite 快取，失敗時只使用記憶體快取"""
+        try:
+            db = sqlite3.connect(TX_CACHE_DB, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS tx_flows(hash TEXT PRIMARY KEY, payload TEXT NOT NULL)")
+            db.commit()
+            return db
+        except sqlite3.Error as e:
+            print(f"⚠️ 無法打開交易快取資料庫: {e}")
+            return None
+    
+    def _load_tx_flows_from_db(self, tx_hash: str):
+        """從 SQLite 讀取交易流動，不存在時返回 None"""
+        if self._tx_db is None:
+            return None
+        try:
+            with self._tx_db_lock:
+                row = self._tx_db.execute("SELECT payload FROM tx_flows WHERE hash=?", (tx_hash,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"      ⚠️ 讀取交易快取失敗: {e}")
+            return None
+        return self._flows_from_payload(json.loads(row[0])) if row else None
+    
+    @staticmethod
+    def _flows_from_payload(payload):
+        """把 SQLite 中的 JSON 轉回緊湊的元組形式（兼容舊版按字典存儲的記錄）"""
+        if isinstance(payload, dict):
+            payload = (payload['from'], payload['to'], payload['value'], payload['internals'])
+        from_addr, to_addr, value, internals = payload
+        return (from_addr, to_addr, value, tuple(tuple(itx) for itx in internals))
+    
+    def _save_tx_flows_to_db(self, tx_hash: str, flows: tuple):
+        """寫入 SQLite（鏈上數據不可變，已存在則忽略）"""
+        if self._tx_db is None:
+            return
+        try:
+            with self._tx_db_lock:
+                self._tx_db.execute("INSERT OR IGNORE INTO tx_flows(hash, payload) VALUES (?, ?)", (tx_hash, json.dumps(flows)))
+                self._tx_db.commit()
+        except sqlite3.Error as e:
+            print(f"      ⚠️ 寫入交易快取失敗: {e}")
+    
+    def _get_api_key_entry(self, cache: OrderedDict, api_key: str, factory):
+        """按 API Key 獲取（或創建）快取項，最多保留 API_KEY_CACHE_SIZE 個最近使用的 Key"""
+        with self._api_key_cache_lock:
+            entry = cache.get(api_key)
+            if entry is None:
+                entry = factory(api_key)
+                cache[api_key] = entry
+                if len(cache) > API_KEY_CACHE_SIZE:
+                    cache.popitem(last=False)
+            else:
+                cache.move_to_end(api_key)
+            return entry
+    
+    def _get_rate_limiter(self, api_key: str) -> RateLimiter:
+        """獲取（或創建）該 API Key 的速率限制器"""
+        return self._get_api_key_entry(
+            self._rate_limiters, api_key,
+            lambda _: RateLimiter(ETHERSCAN_MAX_CALLS_PER_SECOND)
+        )
+    
+    def _fetch_tx_flows(self, api_key: str, tx_hash: str, tx: dict = None, token_address: str = None):
+        """獲取交易的 BNB 流動原始數據（與地址無關，按 tx_hash 快取）
+        
+        返回 (from, to, value, ((from, to, value), ...))（value 單位為 wei，元組比字典省記憶體），
+        查詢失敗時返回 None（不寫入快取，下次重新查詢）；已批量獲取的主交易可通過 tx 傳入，省去一次 API 調用；
+        傳入 token_address 時，直接調用代幣合約的普通轉賬不再查內部交易
+        """
+        flows = self._get_cached_tx_flows(tx_hash)
+        if flows is not None:
+            return flows
+        
+        # 快取都沒有時才調用 API
+        flows = self._query_tx_flows(api_key, tx_hash, tx, token_address)
+        if flows is not None:
+            self._save_tx_flows_to_db(tx_hash, flows)
+            self._remember_tx_flows(tx_hash, flows)
+        return flows
+    
+    def _get_cached_tx_flows(self, tx_hash: str):
+        """從記憶體或磁碟快取讀取交易的 BNB 流動，都沒有時返回 None"""
+        with self._tx_flow_lock:
+            flows = self._tx_flow_cache.get(tx_hash)
+        if flows is not None:
+            return flows
+        
+        # 記憶體沒有時查磁碟快取
+        flows = self._load_tx_flows_from_db(tx_hash)
+        if flows is not None:
+            self._remember_tx_flows(tx_hash, flows)
+        return flows
+    
+    def _remember_tx_flows(self, tx_hash: str, flows: tuple):
+        """寫入記憶體快取"""
+        with self._tx_flow_lock:
+            self._tx_flow_cache[tx_hash] = flows
+            # 超過上限時淘汰最早寫入的記錄
+            while len(self._tx_flow_cache) > TX_FLOW_CACHE_SIZE:
+                del self._tx_flow_cache[next(iter(self._tx_flow_cache))]
+    
+    def _batch_get_transactions(self, tx_hashes: list) -> dict:
+        """經 BSC 節點的 JSON-RPC 批量請求獲取主交易（一個 HTTP 請求查多筆），返回 {tx_hash: tx}
+        
+        失敗或節點沒有返回的交易不在結果中，由調用方退回 Etherscan 逐筆查詢
+        """
+        payload = [
+            {"jsonrpc": "2.0", "id": i, "method": "eth_getTransactionByHash", "params": [tx_hash]}
+            for i, tx_hash in enumerate(tx_hashes)
+        ]
+        try:
+            response = self.session.post(BSC_RPC_URL, json=payload, timeout=30)
+            response.raise_for_status()
+            replies = orjson.loads(response.content) if orjson else response.json()
+        except Exception as e:
+            print(f"      ⚠️ 批量獲取交易失敗，改用 Etherscan 逐筆查詢: {e}")
+            return {}
+        
+        if not isinstance(replies, list):
+            return {}
+        
+        txs = {}
+        for reply in replies:
+            tx = reply.get("result") if isinstance(reply, dict) else None
+            index = reply.get("id") if isinstance(tx, dict) else None
+            if isinstance(index, int) and 0 <= index < len(tx_hashes):
+                txs[tx_hashes[index]] = tx
+        return txs
+    
+    def _fetch_tx_flows_batch(self, api_key: str, tx_hashes: list, token_address: str = None) -> list:
+        """查詢一批交易的 BNB 流動：快取之外的主交易先批量獲取，內部交易再逐筆補查，返回 [(tx_hash, flows)]"""
+        results = {tx_hash: self._get_cached_tx_flows(tx_hash) for tx_hash in tx_hashes}
+        pending = [tx_hash for tx_hash, flows in results.items() if flows is None]
+        if pending:
+            main_txs = self._batch_get_transactions(pending)
+            for tx_hash in pending:
+                results[tx_hash] = self._fetch_tx_flows(api_key, tx_hash, main_txs.get(tx_hash), token_address)
+        return list(results.items())
+    
+    def _query_tx_flows(self, api_key: str, tx_hash: str, tx: dict = None, token_address: str = None):
+        """從 Etherscan 查詢交易的主交易和內部交易（已批量獲取主交易時直接使用）"""
         try:
-            address = address.lower()
-            
             # 首先檢查主交易的 value
-            params = {
-                "module": "proxy",
-                "action": "eth_getTransactionByHash",
-                "txhash": tx_hash
-            }
+            if tx is None:
+                params = {
+                    "module": "proxy",
+                    "action": "eth_getTransactionByHash",
+                    "txhash": tx_hash
+                }
+                
+                data = self._call_etherscan_v2_api(api_key, params)
+                tx = data.get("result")
             
-            main_tx_bnb_out = 0
-            main_tx_bnb_in = 0
+            # 檢查 result 是否為字典（可能是錯誤訊息字串）
+            if not isinstance(tx, dict):
+                print(f"      ⚠️ 交易數據格式錯誤: {tx}")
+                return None
             
-            data = self._call_etherscan_v2_api(api_key, params)
-            if data.get("result"):
-                tx = data["result"]
-                
-                # 檢查 result 是否為字典（可能是錯誤訊息字串）
-                if not isinstance(tx, dict):
-                    print(f"      ⚠️ 交易數據格式錯誤: {tx}")
-                    return {'bnb_in': 0, 'bnb_out': 0, 'net_bnb': 0}
-                
-                from_addr = tx.get('from', '').lower()
-                to_addr = tx.get('to', '').lower()
-                value_hex = tx.get('value', '0x0')
-                
-                # 處理十六進制值
-                if isinstance(value_hex, str):
-                    value = int(value_hex, 16) if value_hex.startswith('0x') else int(value_hex)
-                else:
-                    value = int(value_hex)
-                
-                # 如果用戶是交易發起者且有 value，說明用戶支付了 BNB
-                if from_addr == address and value > 0:
-                    main_tx_bnb_out = value / 1e18
-                # 如果用戶是接收者且有 value，說明用戶收到了 BNB
-                elif to_addr == address and value > 0:
-                    main_tx_bnb_in = value / 1e18
+            # JSON-RPC 返回的 value 固定是 0x 開頭的十六進制字串，int(x, 16) 直接接受 0x 前綴
+            value = int(tx.get('value') or '0x0', 16)
+            
+            from_addr = (tx.get('from') or '').lower()
+            to_addr = (tx.get('to') or '').lower()
             
-            # 然後檢查內部交易
+            # 主交易已帶 BNB（直接支付的買入），BNB 流動已由主交易說明，
+            # 不需要再發一次 txlistinternal 請求
+            if value > 0:
+                return (from_addr, to_addr, value, ())
+            
+            # 不帶 BNB、直接調用代幣合約的交易是錢包之間的普通轉賬，沒有經過路由合約，
+            # 不會產生流向用戶的 BNB，同樣不需要查內部交易
+            if token_address and to_addr == token_address:
+                return (from_addr, to_addr, value, ())
+            
+            # 然後檢查內部交易（主交易沒有 BNB 時才需要，例如經由合約賣出）
             params = {
                 "module": "account",
                 "action": "txlistinternal",
@@ -347,46 +1096,86 @@ class FourMemeAnalyzer:
                 "sort": "asc"
             }
             
-            internal_bnb_in = 0
-            internal_bnb_out = 0
-            
             data = self._call_etherscan_v2_api(api_key, params)
             if data.get("status") == "1" and data.get("result"):
-                internal_txs = data["result"]
-                
-                for tx in internal_txs:
-                    from_addr = tx.get('from', '').lower()
-                    to_addr = tx.get('to', '').lower()
-                    value = int(tx.get('value', 0))
-                    
-                    if to_addr == address:
-                        internal_bnb_in += value / 1e18
-                    if from_addr == address:
-                        internal_bnb_out += value / 1e18
-            
-            # 合併主交易和內部交易的結果
-            total_bnb_in = main_tx_bnb_in + internal_bnb_in
-            total_bnb_out = main_tx_bnb_out + internal_bnb_out
+                # txlistinternal 的 value 是十進制字串，字段固定存在
+                internals = tuple(
+                    (itx['from'].lower(), itx['to'].lower(), int(itx['value']))
+                    for itx in data["result"]
+                )
+            elif str(data.get("message", "")).startswith("No transactions found"):
+                internals = ()
+            else:
+                # 限速或網路錯誤，不能當作「沒有內部交易」快取
+                return None
             
-            return {
-                'bnb_in': total_bnb_in,
-                'bnb_out': total_bnb_out,
-                'net_bnb': total_bnb_in - total_bnb_out
-            }
+            return (from_addr, to_addr, value, internals)
             
         except Exception as e:
             print(f"      獲取 BNB 金額失敗: {e}")
-            return {'bnb_in': 0, 'bnb_out': 0, 'net_bnb': 0}
+            return None
+    
+    @staticmethod
+    def _project_flows_for_address(flows, address: str) -> tuple:
+        """計算某地址在一筆交易中的 BNB 流出/流入（純計算，不調用 API），返回 (bnb_out, bnb_in)"""
+        if not flows:
+            return 0.0, 0.0
+        
+        bnb_in = 0
+        bnb_out = 0
+        
+        tx_from, tx_to, value, internals = flows
+        
+        # 如果用戶是交易發起者且有 value，說明用戶支付了 BNB
+        if value > 0:
+            if tx_from == address:
+                bnb_out += value / 1e18
+            # 如果用戶是接收者且有 value，說明用戶收到了 BNB
+            elif tx_to == address:
+                bnb_in += value / 1e18
+        
+        # 內部交易
+        for from_addr, to_addr, value in internals:
+            if to_addr == address:
+                bnb_in += value / 1e18
+            if from_addr == address:
+                bnb_out += value / 1e18
+        
+        return bnb_out, bnb_in
     
     def _get_bnb_price_usd(self) -> float:
-        """獲取 BNB 當前 USD 價格"""
+        """獲取 BNB 當前 USD 價格（TTL 快取，並發的分析共用同一個結果）"""
+        with self._bnb_price_lock:
+            cached_price, fetched_at = self._bnb_price_cache
+            if cached_price > 0 and time.monotonic() - fetched_at < BNB_PRICE_TTL:
+                print(f"   ✅ BNB 價格: ${cached_price:.2f} USD (快取)")
+                return cached_price
+            
+            recently_failed = (self._bnb_price_failed_at is not None
+                               and time.monotonic() - self._bnb_price_failed_at < BNB_PRICE_FAILURE_TTL)
+            price = 0.0 if recently_failed else self._fetch_bnb_price_usd()
+            if price > 0:
+                self._bnb_price_cache = (price, time.monotonic())
+                self._bnb_price_failed_at = None
+                return price
+            if not recently_failed:
+                self._bnb_price_failed_at = time.monotonic()
+            
+            # 價格 API 暫時不可用時，短時間內沿用舊價格
+            if cached_price > 0 and time.monotonic() - fetched_at < BNB_PRICE_STALE_TTL:
+                print(f"   ⚠️  沿用快取的 BNB 價格: ${cached_price:.2f} USD")
+                return cached_price
+            return 0.0
+    
+    def _fetch_bnb_price_usd(self) -> float:
+        """從 Binance / CoinGecko 獲取 BNB 當前 USD 價格"""
         try:
             print(f"   正在獲取 BNB 價格...")
             
             # 方案 1: Binance API（最可靠）
             try:
                 url = "https://api.binance.com/api/v3/ticker/price?symbol=BNBUSDT"
-                response = self.session.get(url, timeout=10)
+                response = self.session.get(url, timeout=BNB_PRICE_TIMEOUT)
                 if response.status_code == 200:
                     data = response.json()
                     price = float(data.get('price', 0))
@@ -399,7 +1188,7 @@ class FourMemeAnalyzer:
             # 方案 2: CoinGecko API（備用）
             try:
                 url = "https://api.coingecko.com/api/v3/simple/price?ids=binancecoin&vs_currencies=usd"
-                response = self.session.get(url, timeout=10)
+                response = self.session.get(url, timeout=BNB_PRICE_TIMEOUT)
                 if response.status_code == 200:
                     data = response.json()
                     price = float(data.get('binancecoin', {}).get('usd', 0))
@@ -418,16 +1207,26 @@ class FourMemeAnalyzer:
     
     def _call_etherscan_v2_api(self, api_key: str, params: dict) -> dict:
         """調用 Etherscan API V2（支持多鏈）"""
-        base_url = "https://api.etherscan.io/v2/api"
+        # BSC Chain ID (56) 和 API Key 固定在地址裡，不再改寫調用方的 params
+        base_url = self._get_api_key_entry(
+            self._api_base_urls, api_key,
+            lambda key: f"https://api.etherscan.io/v2/api?chainid=56&apikey={key}"
+        )
         
-        # 添加 BSC Chain ID (56) 和 API Key
-        params["chainid"] = "56"  # BNB Smart Chain
-        params["apikey"] = api_key
+        # 等待速率限制器放行（多線程共享同一個 Key 的額度）
+        self._get_rate_limiter(api_key).acquire()
         
         try:
             response = self.session.get(base_url, params=params, timeout=30)
             response.raise_for_status()
-            data = response.json()
+            body = response.content
+            
+            # 「沒有交易」是翻頁結束和查內部交易時的正常回應，不必解析也不打印錯誤
+            if len(body) < 256 and b'No transactions found' in body:
+                return {"status": "0", "result": [], "message": "No transactions found"}
+            
+            # tokentx 每頁可達 10000 筆，解析成本不小，優先使用 orjson
+            data = orjson.loads(body) if orjson else response.json()
             
             # 打印詳細錯誤信息
             if data.get("status") == "0":
@@ -486,43 +1285,36 @@ class FourMemeAnalyzer:
         token_info = {"name": "Unknown", "symbol": "Unknown", "decimals": 18}
         
         # 獲取所有交易
+        # Etherscan 限制 page × offset ≤ 10000，因此用 startblock 游標翻頁，page 固定為 1
+        first_page, error = self._fetch_transfer_page(api_key, token_address, 0, 99999999)
+        if error is not None:
+            return {"success": False, "error": f"API 錯誤: {error}", "token_info": token_info}
+        
+        pages = [first_page]
+        if len(first_page) >= TRANSFER_PAGE_SIZE:
+            # 一頁取不完：把剩下的區塊切成幾段並發翻頁，不必一頁一頁串行等待
+            last_block = first_page[-1]['blockNumber']
+            latest_block = self._get_latest_block(api_key)
+            ranges = self._split_block_range(last_block, latest_block, TRANSFER_FETCH_PARTITIONS)
+            print(f"   交易較多，分 {len(ranges)} 段並發獲取（區塊 {last_block} 起）...")
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                range_results = list(executor.map(lambda r: self._fetch_transfer_range(api_key, token_address, *r), ranges))
+            for range_pages, range_error in range_results:
+                if range_error is not None:
+                    # 不拼接缺頁的交易列表（失敗結果也不會寫入結果快取）
+                    return {"success": False, "error": f"API 錯誤: {range_error}", "token_info": token_info}
+                pages.extend(range_pages)
+        
+        # 各段按區塊順序拼接；相鄰頁會重複返回邊界區塊的交易，在這裡去重
         all_transfers = []
-        page = 1
-        
-        while True:
-            params = {
-                "module": "account",
-                "action": "tokentx",
-                "contractaddress": token_address,
-                "startblock": 0,
-                "endblock": 99999999,
-                "page": page,
-                "offset": 10000,
-                "sort": "asc",
-            }
-            
-            data = self._call_etherscan_v2_api(api_key, params)
-            
-            if data.get("status") == "0":
-                if not all_transfers:
-                    return {"success": False, "error": f"API 錯誤: {data.get('message', '')}", "token_info": token_info}
-                break
-            
-            if not data.get("result"):
-                break
-            
-            transfers = data["result"]
-            if isinstance(transfers, str):
-                return {"success": False, "error": f"API 錯誤: {transfers}", "token_info": token_info}
-            
-            all_transfers.extend(transfers)
-            print(f"   已獲取 {len(all_transfers)} 筆交易...")
-            
-            if len(transfers) < 10000:
-                break
-            
-            page += 1
-            time.sleep(0.25)
+        seen_transfers = set()
+        for transfers in pages:
+            for tx in transfers:
+                key = (tx.get('hash'), tx.get('logIndex'), tx.get('from'), tx.get('to'), tx.get('value'))
+                if key not in seen_transfers:
+                    seen_transfers.add(key)
+                    all_transfers.append(tx)
+        print(f"   已獲取 {len(all_transfers)} 筆交易...")
         
         if not all_transfers:
             return {"success": False, "error": "找不到任何交易記錄", "token_info": token_info}
@@ -557,9 +1349,105 @@ class FourMemeAnalyzer:
         # 傳遞機器人閾值
         token_info["max_txs_per_buyer"] = max_txs_per_buyer
         
-        return self._analyze_transfers(all_transfers, token_info, start_seconds, end_seconds, api_key, update_progress=update_progress)
+        return self._analyze_transfers(all_transfers, token_info, start_seconds, end_seconds, api_key, update_progress=update_progress, token_address=token_address)
+    
+    def _fetch_transfer_page(self, api_key: str, token_address: str, start_block: int, end_block: int):
+        """獲取區塊區間內的一頁代幣轉賬（按區塊升序，最多 TRANSFER_PAGE_SIZE 筆），返回 (transfers, error)
+        
+        區間內沒有交易不算錯誤（返回空列表）；限速等錯誤按 TRANSFER_PAGE_RETRIES 重試
+        """
+        params = {
+            "module": "account",
+            "action": "tokentx",
+            "contractaddress": token_address,
+            "startblock": start_block,
+            "endblock": end_block,
+            "page": 1,
+            "offset": TRANSFER_PAGE_SIZE,
+            "sort": "asc",
+        }
+        
+        error = None
+        for attempt in range(TRANSFER_PAGE_RETRIES + 1):
+            if attempt:
+                print(f"   🔁 重試獲取交易頁（區塊 {start_block} 起，第 {attempt} 次）: {error}")
+                time.sleep(attempt)
+            
+            data = self._call_etherscan_v2_api(api_key, params)
+            
+            if data.get("status") == "0":
+                if data.get('message') == 'No transactions found':
+                    return [], None
+                # 限速時 result 裡才是具體原因（message 只有 NOTOK）
+                result = data.get('result')
+                error = result if isinstance(result, str) and result else data.get('message', '')
+                continue
+            
+            transfers = data.get("result") or []
+            if isinstance(transfers, str):
+                error = transfers
+                continue
+            
+            self._normalize_transfers(transfers)
+            return transfers, None
+        return [], error
+    
+    def _fetch_transfer_range(self, api_key: str, token_address: str, start_block: int, end_block: int):
+        """用 startblock 游標取完一個區塊區間內的所有轉賬，返回 (頁列表, error)（邊界區塊會重複，由調用方去重）
+        
+        重試後仍失敗的頁返回錯誤：中間缺頁會讓之後的買賣歸屬錯誤，不能當作區間已取完
+        """
+        pages = []
+        while True:
+            transfers, error = self._fetch_transfer_page(api_key, token_address, start_block, end_block)
+            if error is not None:
+                return pages, error
+            if not transfers:
+                break
+            pages.append(transfers)
+            
+            if len(transfers) < TRANSFER_PAGE_SIZE:
+                break
+            
+            # 最後一個區塊可能還有交易沒返回，所以從該區塊（而不是下一個區塊）繼續
+            last_block = transfers[-1]['blockNumber']
+            if last_block <= start_block:
+                print(f"   ⚠️  區塊 {last_block} 內交易超過 {TRANSFER_PAGE_SIZE} 筆，無法繼續翻頁")
+                break
+            start_block = last_block
+        return pages, None
+    
+    def _get_latest_block(self, api_key: str) -> int:
+        """獲取鏈上最新區塊號，失敗時返回 0"""
+        data = self._call_etherscan_v2_api(api_key, {"module": "proxy", "action": "eth_blockNumber"})
+        try:
+            return int(data.get("result"), 16)
+        except (TypeError, ValueError):
+            return 0
+    
+    @staticmethod
+    def _split_block_range(start_block: int, latest_block: int, partitions: int) -> list:
+        """把 [start_block, 最新區塊] 平均切成幾段，最後一段不封頂（包含之後的新區塊）"""
+        span = latest_block - start_block
+        if span < partitions:
+            return [(start_block, 99999999)]
+        step = span // partitions
+        bounds = [start_block + step * i for i in range(partitions)]
+        return [(lo if i == 0 else lo + 1, bounds[i + 1] if i + 1 < partitions else 99999999)
+                for i, lo in enumerate(bounds)]
     
-    def _analyze_transfers(self, transfers: List[dict], token_info: dict, start_seconds: int, end_seconds: int, api_key: str = None, update_progress=None) -> dict:
+    @staticmethod
+    def _normalize_transfers(transfers: List[dict]):
+        """在取得頁面後立即轉換字段類型（Etherscan 返回的數值都是字串）"""
+        for tx in transfers:
+            tx['timeStamp'] = int(tx['timeStamp'])
+            tx['value'] = int(tx['value'])
+            tx['blockNumber'] = int(tx['blockNumber'])
+            # 地址只轉小寫一次，並 intern 讓後續字典查找可直接比較指針
+            tx['from'] = sys.intern(tx['from'].lower())
+            tx['to'] = sys.intern(tx['to'].lower())
+    
+    def _analyze_transfers(self, transfers: List[dict], token_info: dict, start_seconds: int, end_seconds: int, api_key: str = None, update_progress=None, token_address: str = None) -> dict:
         """分析交易數據（時間區間版本）"""
         
         # 如果沒有傳入 update_progress，使用空函數
@@ -569,18 +1457,13 @@ class FourMemeAnalyzer:
         if not transfers:
             return {"success": False, "error": "沒有交易數據", "token_info": token_info}
         
-        # 確保所有時間戳和數值字段都是正確的類型
-        for tx in transfers:
-            if 'timeStamp' in tx and isinstance(tx['timeStamp'], str):
-                tx['timeStamp'] = int(tx['timeStamp'])
-            if 'value' in tx and isinstance(tx['value'], str):
-                tx['value'] = int(tx['value'])
-            if 'tokenDecimal' in tx and isinstance(tx['tokenDecimal'], str):
-                tx['tokenDecimal'] = int(tx['tokenDecimal'])
-            if 'blockNumber' in tx and isinstance(tx['blockNumber'], str):
-                tx['blockNumber'] = int(tx['blockNumber'])
-        
-        creation_time = min(tx['timeStamp'] for tx in transfers)
+        # tokentx 按 sort=asc 獲取，時間戳應為升序；萬一不是則先排序
+        ts_array = [tx['timeStamp'] for tx in transfers]
+        if not all(map(operator.le, ts_array, ts_array[1:])):
+            transfers.sort(key=operator.itemgetter('timeStamp'))
+            ts_array.sort()
+        
+        creation_time = ts_array[0]
         start_cutoff_time = creation_time + start_seconds  # 區間起始
         end_cutoff_time = creation_time + end_seconds      # 區間結束
         
@@ -588,68 +1471,88 @@ class FourMemeAnalyzer:
         print(f"   區間起始: {datetime.fromtimestamp(start_cutoff_time).strftime('%Y-%m-%d %H:%M:%S')}")
         print(f"   區間結束: {datetime.fromtimestamp(end_cutoff_time).strftime('%Y-%m-%d %H:%M:%S')}")
         
+        # 排除系統地址（鑄造/銷毀）：開盤時間已取自完整列表，之後只處理過濾後的交易，
+        # 後面的聚合和區間掃描都不必再逐筆判斷
+        transfers = [
+            tx for tx in transfers
+            if tx['from'] not in EXCLUDE_ADDRESSES and tx['to'] not in EXCLUDE_ADDRESSES
+        ]
+        ts_array = [tx['timeStamp'] for tx in transfers]
+        
         early_buyers = {}
-        all_buyers = {}
         
-        # 用於記錄每個地址的所有交易 hash
-        address_txs = {}  # {address: [(tx_hash, 'buy'/'sell', timestamp)]}
+        # 所有買家的統計用「結構數組」存放：地址 -> 下標，每個字段一個平行列表，
+        # 比每個地址一個字典省記憶體，熱路徑也只做列表下標運算
+        buyer_index = {}
+        first_buy_times = []
+        buy_amounts = []
+        sell_amounts = []
+        buy_counts = []
+        sell_counts = []
+        last_sell_times = []
+        # 每個地址的所有交易 hash 也按下標存放：[(tx_hash, 'buy'/'sell', timestamp)]
+        tx_lists = []
+        
+        # 同一合約的 tokenDecimal 固定，換算係數只算一次，熱路徑只做一次浮點乘法
+        inv_scale = 1.0 / (10 ** token_info['decimals'])
         
         for tx in transfers:
-            from_addr = tx['from'].lower()
-            to_addr = tx['to'].lower()
+            from_addr = tx['from']
+            to_addr = tx['to']
             value = tx['value']
             timestamp = tx['timeStamp']
-            decimal = tx.get('tokenDecimal', token_info['decimals'])
             tx_hash = tx.get('hash', '')
             
-            # 排除系統地址
-            if from_addr in EXCLUDE_ADDRESSES or to_addr in EXCLUDE_ADDRESSES:
-                continue
-            
             # 記錄所有買家
-            if to_addr not in all_buyers:
-                all_buyers[to_addr] = {
-                    'first_buy_time': timestamp,
-                    'buy_amount': 0,
-                    'sell_amount': 0,
-                    'buy_count': 0,
-                    'sell_count': 0,
-                    'last_sell_time': 0
-                }
-                address_txs[to_addr] = []
+            i = buyer_index.get(to_addr)
+            if i is None:
+                i = buyer_index[to_addr] = len(buy_amounts)
+                first_buy_times.append(timestamp)
+                buy_amounts.append(0)
+                sell_amounts.append(0)
+                buy_counts.append(0)
+                sell_counts.append(0)
+                last_sell_times.append(0)
+                tx_lists.append([])
             
             # 買入
-            token_amount = value / (10 ** decimal)  # 轉換為真實數量
-            all_buyers[to_addr]['buy_amount'] += token_amount
-            all_buyers[to_addr]['buy_count'] += 1
+            token_amount = value * inv_scale  # 轉換為真實數量
+            buy_amounts[i] += token_amount
+            buy_counts[i] += 1
             if tx_hash:
-                address_txs[to_addr].append((tx_hash, 'buy', timestamp))
+                tx_lists[i].append((tx_hash, 'buy', timestamp))
             
             # 賣出（from）
-            if from_addr in all_buyers:
-                all_buyers[from_addr]['sell_amount'] += token_amount
-                all_buyers[from_addr]['sell_count'] += 1
-                all_buyers[from_addr]['last_sell_time'] = timestamp
-                if tx_hash and from_addr in address_txs:
-                    address_txs[from_addr].append((tx_hash, 'sell', timestamp))
-            
-            # 識別區間內的買家（修改：在 start_seconds 到 end_seconds 之間）
-            if start_cutoff_time <= timestamp <= end_cutoff_time and to_addr not in early_buyers:
+            i = buyer_index.get(from_addr)
+            if i is not None:
+                sell_amounts[i] += token_amount
+                sell_counts[i] += 1
+                last_sell_times[i] = timestamp
+                if tx_hash:
+                    tx_lists[i].append((tx_hash, 'sell', timestamp))
+        
+        # 用於記錄每個地址的所有交易 hash（buyer_index 按插入順序編號，與 tx_lists 一一對應）
+        address_txs = dict(zip(buyer_index, tx_lists))  # {address: [(tx_hash, 'buy'/'sell', timestamp)]}
+        
+        # 識別區間內的買家（在 start_seconds 到 end_seconds 之間）
+        # 時間戳有序，二分查找區間邊界後只遍歷區間內的交易
+        window_start = bisect_left(ts_array, start_cutoff_time)
+        window_end = bisect_right(ts_array, end_cutoff_time)
+        # 區間內的每個接收地址在聚合時都已登記，直接帶上完整交易統計，不再另跑一輪合併
+        for tx in transfers[window_start:window_end]:
+            to_addr = tx['to']
+            if to_addr not in early_buyers:
+                i = buyer_index[to_addr]
                 early_buyers[to_addr] = {
                     'address': to_addr,
-                    'first_buy_time': timestamp,
-                    'buy_amount': 0,
-                    'sell_amount': 0,
-                    'buy_count': 0,
-                    'sell_count': 0,
-                    'last_sell_time': 0
+                    'first_buy_time': first_buy_times[i],
+                    'buy_amount': buy_amounts[i],
+                    'sell_amount': sell_amounts[i],
+                    'buy_count': buy_counts[i],
+                    'sell_count': sell_counts[i],
+                    'last_sell_time': last_sell_times[i]
                 }
         
-        # 計算早期買家的完整交易統計
-        for addr in early_buyers:
-            if addr in all_buyers:
-                early_buyers[addr].update(all_buyers[addr])
-        
         # 【新增】精準計算 BNB 成本和利潤
         use_bnb_calculation = api_key and token_info.get('bnb_price_usd', 0) > 0
         
@@ -705,35 +1608,53 @@ class FourMemeAnalyzer:
             
             # ===== 優化：第二階段 - 批次查詢所有交易（按地址快取） =====
             print(f"\n   💰 階段 2/2: 批次查詢 BNB 流動...")
-            # 使用二維快取：tx_cache[address][tx_hash] = bnb_data
-            tx_cache = {}
+            # 按 tx_hash 查詢（同一筆交易的數據對所有買家共用，只查一次）
+            tx_flows = {}
             queried_count = 0
-            total_queries_needed = sum(len(txs) for txs in valid_buyers.values())
+            total_queries_needed = len(all_tx_hashes)
             
-            for addr, buyer_txs in valid_buyers.items():
-                if addr not in tx_cache:
-                    tx_cache[addr] = {}
-                
-                for tx_hash, tx_type, timestamp in buyer_txs:
-                    # 只查詢該地址還沒查過的交易
-                    if tx_hash not in tx_cache[addr]:
-                        tx_cache[addr][tx_hash] = self._get_bnb_amount_from_tx(api_key, tx_hash, addr)
-                        queried_count += 1
-                        
-                        # 每秒 5 次（你的付費版限制）
-                        time.sleep(0.2)
+            query_done = threading.Event()
+            
+            def progress_pump():
+                """定時把查詢進度寫入 session（與查詢解耦，每個間隔最多寫一次）"""
+                last_reported = 0
+                while not query_done.wait(PROGRESS_UPDATE_INTERVAL):
+                    completed = queried_count
+                    if completed == last_reported:
+                        continue
+                    last_reported = completed
+                    update_progress(
+                        stage='查詢交易',
+                        progress=40 + int(40 * completed / total_queries_needed),  # 40-80%
+                        message=f'已查詢 {completed}/{total_queries_needed} 筆交易',
+                        total=total_queries_needed,
+                        completed=completed
+                    )
+            
+            pump = threading.Thread(target=progress_pump, daemon=True)
+            pump.start()
+            
+            # 按批並發查詢：每批的主交易合併成一個 JSON-RPC 請求，Etherscan 調用由速率限制器控制每秒請求數
+            hash_list = list(all_tx_hashes)
+            try:
+                with ThreadPoolExecutor(max_workers=BNB_LOOKUP_WORKERS) as executor:
+                    futures = [
+                        executor.submit(self._fetch_tx_flows_batch, api_key, hash_list[i:i + TX_BATCH_SIZE], token_address)
+                        for i in range(0, len(hash_list), TX_BATCH_SIZE)
+                    ]
+                    
+                    next_report = 50
+                    for future in as_completed(futures):
+                        batch_results = future.result()
+                        tx_flows.update(batch_results)
+                        queried_count += len(batch_results)
                         
-                        # 進度提示
-                        if queried_count % 50 == 0:
-                            progress_pct = 40 + int(40 * queried_count / total_queries_needed)  # 40-80%
-                            update_progress(
-                                stage='查詢交易',
-                                progress=progress_pct,
-                                message=f'已查詢 {queried_count}/{total_queries_needed} 筆交易',
-                                total=total_queries_needed,
-                                completed=queried_count
-                            )
+                        if queried_count >= next_report:
+                            next_report = (queried_count // 50 + 1) * 50
                             print(f"      ✅ 已查詢 {queried_count}/{total_queries_needed} 筆 ({queried_count/total_queries_needed*100:.1f}%)")
+            finally:
+                query_done.set()
+                pump.join()
             
             print(f"   ✅ 查詢完成！共 {queried_count} 筆交易")
             
@@ -741,32 +1662,26 @@ class FourMemeAnalyzer:
             # ===== 第三階段 - 使用快取計算利潤（快速，不調用 API） =====
             print(f"\n   🧮 計算利潤中...")
             processed_buyers = 0
+            project = self._project_flows_for_address
             
             for addr, buyer_txs in valid_buyers.items():
                 processed_buyers += 1
                 
+                # 從快取計算該地址的流動（不調用 API）：買入取用戶支付的 BNB，賣出取用戶收到的 BNB
                 bnb_spent = 0
                 bnb_received = 0
-                
-                for tx_hash, tx_type, timestamp in buyer_txs:
-                    # 從快取讀取（不調用 API，瞬間完成）
-                    bnb_data = tx_cache[addr].get(tx_hash, {'bnb_out': 0, 'bnb_in': 0})
-                    
+                for tx_hash, tx_type, _ in buyer_txs:
+                    bnb_out, bnb_in = project(tx_flows.get(tx_hash), addr)
                     if tx_type == 'buy':
-                        # 買入：用戶支付 BNB
-                        bnb_spent += bnb_data['bnb_out']
-                    else:  # sell
-                        # 賣出：用戶收到 BNB
-                        bnb_received += bnb_data['bnb_in']
+                        bnb_spent += bnb_out
+                    else:
+                        bnb_received += bnb_in
                 
-                early_buyers[addr]['bnb_spent'] = bnb_spent
-                early_buyers[addr]['bnb_received'] = bnb_received
-                early_buyers[addr]['bnb_profit'] = bnb_received - bnb_spent
-                early_buyers[addr]['is_bot'] = False
-                
-                # 進度提示（計算很快）
-                if processed_buyers % 20 == 0:
-                    print(f"      ✅ 已計算 {processed_buyers}/{len(valid_buyers)} 人")
+                buyer = early_buyers[addr]
+                buyer['bnb_spent'] = bnb_spent
+                buyer['bnb_received'] = bnb_received
+                buyer['bnb_profit'] = bnb_received - bnb_spent
+                buyer['is_bot'] = False
             
             print(f"   ✅ 計算完成！")
             print(f"\n   📊 統計摘要:")
@@ -774,26 +1689,40 @@ class FourMemeAnalyzer:
             print(f"      跳過了 {skipped_buyers} 個疑似機器人")
             print(f"      查詢了 {queried_count} 筆交易")
         
-        # 計算早期買家的完整交易統計
-        for addr in early_buyers:
-            if addr in all_buyers:
-                early_buyers[addr].update(all_buyers[addr])
-        
         # 轉換為列表並計算持倉、利潤、倍數
         early_buyers_list = []
         current_time = int(time.time())
         price_usd = token_info.get('price_usd', 0.0)
-        
-        for addr, data in early_buyers.items():
-            decimal = token_info['decimals']
-            buy_amount = data['buy_amount'] / (10 ** decimal)
-            sell_amount = data['sell_amount'] / (10 ** decimal)
+        bnb_price_usd = token_info.get('bnb_price_usd', 0)
+        # 價格對所有買家相同，有沒有價格只需判斷一次
+        has_bnb_price = bnb_price_usd > 0
+        has_token_price = price_usd > 0
+        amount_scale = 10 ** token_info['decimals']
+        append_buyer = early_buyers_list.append
+        # 同一區塊的買家時間戳相同，格式化結果按時間戳複用
+        time_strings = {}
+        # 統計在生成記錄時順帶累加，不再另外遍歷列表
+        cleared_buyers = 0
+        total_buy = 0
+        
+        # 按首次買入時間（整數時間戳）排序後再生成記錄，輸出列表天然有序
+        ordered_buyers = sorted(early_buyers.items(), key=lambda item: item[1]['first_buy_time'])
+        
+        # 每個買家只有幾次標量運算，循環不變量（價格、精度）都已提到循環外
+        for addr, data in ordered_buyers:
+            buy_amount = data['buy_amount'] / amount_scale
+            sell_amount = data['sell_amount'] / amount_scale
             holding = buy_amount - sell_amount
+            total_buy += buy_amount
             
             sell_ratio = (sell_amount / buy_amount * 100) if buy_amount > 0 else 0
             
             # 計算持倉時間
             first_buy_timestamp = data['first_buy_time']
+            first_buy_time = time_strings.get(first_buy_timestamp)
+            if first_buy_time is None:
+                first_buy_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(first_buy_timestamp))
+                time_strings[first_buy_timestamp] = first_buy_time
             last_sell_timestamp = data.get('last_sell_time', current_time)
             
             # 如果還持有，持倉時間到現在；如果已清倉，持倉時間到最後賣出
@@ -803,6 +1732,7 @@ class FourMemeAnalyzer:
             else:
                 holding_duration = last_sell_timestamp - first_buy_timestamp
                 is_holding = False
+                cleared_buyers += 1
             
             # 格式化持倉時間
             hours = holding_duration // 3600
@@ -817,15 +1747,13 @@ class FourMemeAnalyzer:
                 holding_time_str = f"{minutes}分鐘"
             
             # 計算利潤和倍數
-            bnb_price_usd = token_info.get('bnb_price_usd', 0)
-            
             # 獲取 BNB 數據（可能不存在）
             bnb_spent = data.get('bnb_spent', 0)
             bnb_received = data.get('bnb_received', 0)
             bnb_profit = bnb_received - bnb_spent
             
             # 判斷是否有有效的 BNB 數據
-            has_valid_bnb_data = (bnb_spent > 0 or bnb_received > 0) and bnb_price_usd > 0
+            has_valid_bnb_data = has_bnb_price and (bnb_spent > 0 or bnb_received > 0)
             
             if has_valid_bnb_data:
                 # 使用精準的 BNB 數據
@@ -864,7 +1792,7 @@ class FourMemeAnalyzer:
                 bnb_received_display = bnb_received
                 bnb_profit_display = bnb_profit
                 
-            elif price_usd > 0:
+            elif has_token_price:
                 # 使用代幣價格估算
                 buy_value_usd = buy_amount * price_usd
                 sell_value_usd = sell_amount * price_usd
@@ -890,38 +1818,33 @@ class FourMemeAnalyzer:
                 bnb_received_display = 0
                 bnb_profit_display = 0
             
-            early_buyers_list.append({
-                'address': addr,
-                'first_buy_time': datetime.fromtimestamp(first_buy_timestamp).strftime('%Y-%m-%d %H:%M:%S'),
-                'buy_amount': buy_amount,
-                'sell_amount': sell_amount,
-                'holding': holding,
-                'sell_ratio': sell_ratio,
-                'status': '仍持倉' if is_holding else '已清倉',
-                'buy_count': data['buy_count'],
-                'sell_count': data['sell_count'],
-                'holding_time': holding_time_str,
-                'holding_duration_seconds': holding_duration,
-                'buy_value_usd': buy_value_usd,
-                'sell_value_usd': sell_value_usd,
-                'holding_value_usd': holding_value_usd,
-                'total_profit_usd': total_profit_usd,
-                'profit_multiple': profit_multiple,
-                'bnb_spent': bnb_spent_display,
-                'bnb_received': bnb_received_display,
-                'bnb_profit': bnb_profit_display,
-                'is_bot': data.get('is_bot', False)
-            })
-        
-        # 按買入時間排序
-        early_buyers_list.sort(key=lambda x: x['first_buy_time'])
+            append_buyer(BuyerRecord(
+                address=addr,
+                first_buy_time=first_buy_time,
+                buy_amount=buy_amount,
+                sell_amount=sell_amount,
+                holding=holding,
+                sell_ratio=sell_ratio,
+                status='仍持倉' if is_holding else '已清倉',
+                buy_count=data['buy_count'],
+                sell_count=data['sell_count'],
+                holding_time=holding_time_str,
+                holding_duration_seconds=holding_duration,
+                buy_value_usd=buy_value_usd,
+                sell_value_usd=sell_value_usd,
+                holding_value_usd=holding_value_usd,
+                total_profit_usd=total_profit_usd,
+                profit_multiple=profit_multiple,
+                bnb_spent=bnb_spent_display,
+                bnb_received=bnb_received_display,
+                bnb_profit=bnb_profit_display,
+                is_bot=data.get('is_bot', False)
+            ))
         
         # 統計
         total_buyers = len(early_buyers_list)
-        cleared_buyers = sum(1 for b in early_buyers_list if b['holding'] <= 0)
         holding_buyers = total_buyers - cleared_buyers
         
-        total_buy = sum(b['buy_amount'] for b in early_buyers_list)
         cleared_ratio = (cleared_buyers / total_buyers * 100) if total_buyers > 0 else 0
         holding_ratio = (holding_buyers / total_buyers * 100) if total_buyers > 0 else 0
         
@@ -952,6 +1875,53 @@ class FourMemeAnalyzer:
 analyzer = FourMemeAnalyzer()
 
 
+def get_request_json():
+    """解析請求體 JSON（有 orjson 時直接解析原始 bytes，跳過 Flask 的標準庫解析）"""
+    if orjson:
+        return orjson.loads(request.get_data())
+    return request.get_json(force=True)
+
+
+def log_exception(message):
+    """記錄當前處理中的異常：調試模式直接打印堆棧，否則交給 app.logger 處理"""
+    if app.debug:
+        traceback.print_exc()
+    else:
+        app.logger.error(message, exc_info=True)
+
+
+def json_response(payload, status=200):
+    """生成 JSON 響應（有 orjson 時用它序列化，完成的進度裡可能有上千個買家）"""
+    if orjson:
+        return app.response_class(
+            orjson.dumps(payload, default=json_default),
+            status=status,
+            mimetype='application/json'
+        )
+    response = jsonify(payload)
+    response.status_code = status
+    return response
+
+
+# 付費驗證用的 Web3 實例（首次使用時創建，之後共用 http_session 的連接池）
+web3_client = None
+web3_lock = Lock()
+
+def get_web3():
+    """獲取共用的 BSC Web3 實例"""
+    global web3_client
+    with web3_lock:
+        if web3_client is None:
+            if Web3 is None:
+                raise RuntimeError('未安裝 web3，無法驗證付費交易')
+            web3_client = Web3(Web3.HTTPProvider(
+                BSC_RPC_URL,
+                request_kwargs={'timeout': 10},
+                session=http_session
+            ))
+        return web3_client
+
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -962,26 +1932,25 @@ def index():
 def health_check():
     """健康檢查端點"""
     cleanup_old_sessions()  # 順便清理舊會話
+    cleanup_result_cache()  # 和過期的結果快取
     return jsonify({
         'status': 'ok',
         'timestamp': time.time(),
-        'active_sessions': len(all_analysis_sessions)
+        'active_sessions': count_sessions()
     }), 200
 
 
 @app.route('/api/system-status', methods=['GET'])
 def get_status():
     """獲取系統狀態"""
-    status = get_system_status()
-    return jsonify(status)
+    status = get_cached_system_status()
+    return json_response(status)
 
 @app.route('/api/verify-payment', methods=['POST'])
 def verify_payment():
     """驗證付費並生成憑證"""
     try:
-        from web3 import Web3
-        
-        data = request.json
+        data = get_request_json()
         tx_hash = data.get('tx_hash') or ""
         if isinstance(tx_hash, str):
             tx_hash = tx_hash.strip()
@@ -989,44 +1958,56 @@ def verify_payment():
         if not tx_hash:
             return jsonify({'success': False, 'error': '缺少交易 Hash'})
         
+        if not isinstance(tx_hash, str) or not TX_HASH_RE.fullmatch(tx_hash):
+            return jsonify({'success': False, 'error': '交易 Hash 格式錯誤'}), 400
+        
         # 檢查是否已使用過此交易
         used_hashes = load_used_tx_hashes()
         if tx_hash in used_hashes:
             return jsonify({'success': False, 'error': '此交易已被使用'})
         
         # 連接 BSC 網路
-        w3 = Web3(Web3.HTTPProvider('https://bsc-dataseed.binance.org/'))
+        w3 = get_web3()
         
         # 獲取交易詳情
         try:
-            tx = w3.eth.get_transaction(tx_hash)
-            receipt = w3.eth.get_transaction_receipt(tx_hash)
+            if hasattr(w3, 'batch_requests'):
+                # web3 v7+：交易和回執合併成一次 RPC 往返
+                with w3.batch_requests() as batch:
+                    batch.add(w3.eth.get_transaction(tx_hash))
+                    batch.add(w3.eth.get_transaction_receipt(tx_hash))
+                    tx, receipt = batch.execute()
+            else:
+                tx = w3.eth.get_transaction(tx_hash)
+                receipt = w3.eth.get_transaction_receipt(tx_hash)
         except Exception as e:
             return jsonify({'success': False, 'error': f'無法獲取交易: {str(e)}'})
         
         # 驗證收款地址
-        if tx['to'].lower() != PAYMENT_RECEIVER.lower():
+        if tx['to'].lower() != PAYMENT_RECEIVER_LOWER:
             return jsonify({'success': False, 'error': '收款地址錯誤'})
         
         # 驗證金額（允許 ±1% 誤差）
         amount_bnb = float(w3.from_wei(tx['value'], 'ether'))
-        expected = PAYMENT_AMOUNT_BNB
-        if not (expected * 0.99 <= amount_bnb <= expected * 1.01):
+        if not (PAYMENT_AMOUNT_BNB_MIN <= amount_bnb <= PAYMENT_AMOUNT_BNB_MAX):
             return jsonify({
                 'success': False, 
-                'error': f'金額錯誤：收到 {amount_bnb} BNB，應為 {expected} BNB'
+                'error': f'金額錯誤：收到 {amount_bnb} BNB，應為 {PAYMENT_AMOUNT_BNB} BNB'
             })
         
         # 驗證交易成功
         if receipt['status'] != 1:
             return jsonify({'success': False, 'error': '交易失敗'})
         
+        # 先在跨進程鎖內標記交易已使用，並發提交同一筆交易時只有一個請求能拿到憑證
+        if not add_used_tx_hash(tx_hash):
+            return jsonify({'success': False, 'error': '此交易已被使用'})
+        
         # 生成付費憑證
-        payment_token = str(uuid.uuid4())
+        payment_token = secrets.token_urlsafe(24)
         
         # 保存憑證
-        tokens = load_payment_tokens()
-        tokens[payment_token] = {
+        save_payment_token(payment_token, {
             'tx_hash': tx_hash,
             'from_address': tx['from'],
             'amount': amount_bnb,
@@ -1034,12 +2015,7 @@ def verify_payment():
             'expiry': time.time() + PAYMENT_TOKEN_EXPIRY,
             'uses_left': PAYMENT_TOKEN_USES,
             'used_times': []
-        }
-        save_payment_tokens(tokens)
-        
-        # 標記交易已使用
-        used_hashes.append(tx_hash)
-        save_used_tx_hashes(used_hashes)
+        })
         
         print(f"✅ 付費驗證成功: {tx_hash[:10]}... → Token: {payment_token[:8]}...")
         
@@ -1052,15 +2028,14 @@ def verify_payment():
         })
         
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        log_exception('付費驗證失敗')
         return jsonify({'success': False, 'error': f'驗證失敗: {str(e)}'})
 
 @app.route('/api/check-payment-token', methods=['POST'])
 def check_payment_token():
     """檢查付費憑證狀態"""
     try:
-        data = request.json
+        data = get_request_json()
         payment_token = data.get('token') or ""
         if isinstance(payment_token, str):
             payment_token = payment_token.strip()
@@ -1098,158 +2073,268 @@ def check_payment_token():
 
 @app.route('/api/progress/<session_id>', methods=['GET'])
 def get_progress_api(session_id):
-    """獲取特定會話的進度（從文件讀取）"""
+    """獲取特定會話的進度（從文件讀取）
+    
+    支援長輪詢：帶 ?wait=秒數 時，分析進行中則等到進度有變化或超時再返回
+    """
+    wait = min(request.args.get('wait', 0, type=float), PROGRESS_LONG_POLL_MAX)
+    if wait > 0:
+        # 先取事件和修改時間再讀 session，讀取之後的寫入都不會漏掉
+        event = get_session_event(session_id)
+        mtime = get_session_mtime(session_id)
+    
     session = get_session(session_id)
+    if session and wait > 0 and session.get('status') == 'processing':
+        wait_for_session_change(session_id, event, mtime, wait)
+        session = get_session(session_id) or session
+    
     if session:
-        return jsonify(session)
+        response = json_response(session)
+        response.headers['Cache-Control'] = 'no-store'
+        if session.get('status') == 'processing':
+            # 不支援長輪詢的客戶端按此間隔重新請求
+            response.headers['Retry-After'] = '2'
+        return response
     else:
+        return json_response({
+            'status': 'error',
+            'message': 'Session not found'
+        }, 404)
+
+# SSE 進度推送：單條連接最長保持時間（秒），之後前端改用長輪詢
+PROGRESS_STREAM_MAX_SECONDS = 900
+
+@app.route('/api/analyze/stream/<session_id>', methods=['GET'])
+def stream_progress_api(session_id):
+    """以 Server-Sent Events 推送會話進度：session 每寫入一次推送一次，完成或出錯後結束"""
+    if get_session_mtime(session_id) is None:
         return jsonify({
             'status': 'error',
             'message': 'Session not found'
         }), 404
-
-@app.route("/api/analyze", methods=["POST"])
-def api_analyze():
-    # 創建新的分析會話
-    session_id = create_analysis_session()
     
-    try:
-        data = request.json
-        
-        # 檢查是否為付費用戶
-        is_paid = data.get("is_paid", False)
-        payment_token = data.get("payment_token") or ""
-        if isinstance(payment_token, str):
-            payment_token = payment_token.strip()
-        
-        # 處理 API Key
-        if is_paid and payment_token:
-            # 付費用戶：驗證憑證並使用付費 API Key
-            tokens = load_payment_tokens()
-            
-            if payment_token not in tokens:
-                return jsonify({"success": False, "error": "付費憑證無效"})
-            
-            token_data = tokens[payment_token]
-            
-            # 檢查過期
-            if time.time() > token_data['expiry']:
-                return jsonify({"success": False, "error": "付費憑證已過期"})
-            
-            # 檢查次數
-            if token_data['uses_left'] <= 0:
-                return jsonify({"success": False, "error": "使用次數已用完"})
+    def generate():
+        deadline = time.monotonic() + PROGRESS_STREAM_MAX_SECONDS
+        last_mtime = None
+        while time.monotonic() < deadline:
+            # 先取事件和修改時間再讀文件，讀取之後的寫入都不會漏掉
+            event = get_session_event(session_id)
+            mtime = get_session_mtime(session_id)
+            if mtime is None:
+                return
             
-            # 扣除使用次數
-            token_data['uses_left'] -= 1
-            token_data['used_times'].append(time.time())
-            save_payment_tokens(tokens)
-            
-            # 使用付費 API Key（隨機選擇）
-            api_key = get_paid_api_key()
-            
-            print(f"💰 付費用戶使用: Token {payment_token[:8]}... 剩餘 {token_data['uses_left']} 次")
+            if mtime != last_mtime:
+                last_mtime = mtime
+                try:
+                    with open(get_session_path(session_id), 'rb') as f:
+                        content = f.read()
+                    session = orjson.loads(content) if orjson else json.loads(content)
+                except (OSError, ValueError):
+                    return
+                # session 文件是單行 JSON，可以直接作為一條事件的 data 發送
+                yield b'data: ' + content + b'\n\n'
+                if session.get('status') != 'processing':
+                    return
+            else:
+                # 心跳，避免代理斷開空閒連接
+                yield b': keepalive\n\n'
             
-        else:
-            # 免費用戶：使用自己的 API Key
-            api_key = data.get("api_key") or ""
-            if isinstance(api_key, str):
-                api_key = api_key.strip()
+            wait_for_session_change(session_id, event, mtime, PROGRESS_LONG_POLL_MAX)
+    
+    return Response(
+        generate(),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-store',
+            'X-Accel-Buffering': 'no'  # 關閉反向代理緩衝，事件立即送達
+        }
+    )
+
+@dataclass(slots=True)
+class AnalyzeRequest:
+    """/api/analyze 的請求參數（一次解析並校驗完畢）"""
+    token_address: str
+    start_total_seconds: int
+    end_total_seconds: int
+    max_txs: int
+    payment_token: str
+    api_key: str
+    
+    @property
+    def is_paid(self):
+        return bool(self.payment_token)
+    
+    @classmethod
+    def from_json(cls, data):
+        """解析請求體；參數無效時拋出 ValueError，訊息直接返回給用戶"""
+        if not isinstance(data, dict):
+            raise ValueError("請求格式錯誤")
+        
+        def text(key):
+            value = data.get(key) or ""
+            return value.strip() if isinstance(value, str) else value
+        
+        # 付費用戶同時帶 is_paid 和憑證，否則按免費用戶處理
+        payment_token = text("payment_token") if data.get("is_paid", False) else ""
+        api_key = "" if payment_token else text("api_key")
+        if not payment_token:
             if not api_key:
-                return jsonify({"success": False, "error": "需要 Etherscan API Key"})
+                raise ValueError("需要 Etherscan API Key")
+            if not isinstance(api_key, str) or not API_KEY_RE.fullmatch(api_key):
+                raise ValueError("API Key 格式錯誤")
+        if not isinstance(payment_token, str):
+            raise ValueError("付費憑證無效")
         
-        token_address = data.get("token_address") or ""
-        if isinstance(token_address, str):
-            token_address = token_address.strip()
+        # 時間區間：分、秒換算為總秒數
+        try:
+            start_total_seconds = int(data.get("start_minutes", 0)) * 60 + int(data.get("start_seconds", 0))
+            end_total_seconds = int(data.get("end_minutes", 0)) * 60 + int(data.get("end_seconds", 0))
+            max_txs = int(data.get("max_txs", 100))
+        except (TypeError, ValueError):
+            raise ValueError("時間和機器人閾值必須是整數")
         
-        # 新增：支援時間區間
-        start_minutes = int(data.get("start_minutes", 0))
-        start_seconds = int(data.get("start_seconds", 0))
-        end_minutes = int(data.get("end_minutes", 0))
-        end_seconds = int(data.get("end_seconds", 0))
+        query_duration = end_total_seconds - start_total_seconds
+        if end_total_seconds <= 0:
+            raise ValueError("結束時間必須大於 0")
+        if start_total_seconds >= end_total_seconds:
+            raise ValueError("起始時間必須小於結束時間")
+        # 限制最多 5 分鐘（300 秒）
+        if query_duration > 300:
+            raise ValueError(f"查詢區間過長！最多 5 分鐘（300 秒），您的設定為 {query_duration} 秒")
         
-        max_txs = int(data.get("max_txs", 100))
+        token_address = text("token_address")
+        if not isinstance(token_address, str) or not TOKEN_RE.fullmatch(token_address):
+            raise ValueError("無效的合約地址格式")
         
-        # 計算總秒數
-        start_total_seconds = (start_minutes * 60) + start_seconds
-        end_total_seconds = (end_minutes * 60) + end_seconds
+        if max_txs < 0:
+            raise ValueError("機器人閾值必須 >= 0")
         
-        # 計算查詢區間
-        query_duration = end_total_seconds - start_total_seconds
+        return cls(token_address, start_total_seconds, end_total_seconds, max_txs, payment_token, api_key)
+
+@app.route("/api/analyze", methods=["POST"])
+def api_analyze():
+    # 先解析並校驗全部參數：無效請求直接返回，不創建會話、不扣除付費次數
+    try:
+        req = AnalyzeRequest.from_json(get_request_json())
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    
+    # 處理 API Key（同樣在創建會話之前：憑證無效時不留下會話）
+    if req.is_paid:
+        # 付費用戶：驗證憑證並使用付費 API Key
+        payment_token = req.payment_token
+        tokens = load_payment_tokens()
         
-        # 驗證
-        if end_total_seconds <= 0:
-            return jsonify({"success": False, "error": "結束時間必須大於 0"})
+        if payment_token not in tokens:
+            return jsonify({"success": False, "error": "付費憑證無效"})
         
-        if start_total_seconds >= end_total_seconds:
-            return jsonify({"success": False, "error": "起始時間必須小於結束時間"})
+        token_data = tokens[payment_token]
         
-        # 限制最多 5 分鐘（300 秒）
-        if query_duration > 300:
-            return jsonify({
-                "success": False, 
-                "error": f"查詢區間過長！最多 5 分鐘（300 秒），您的設定為 {query_duration} 秒"
-            })
+        # 檢查過期
+        if time.time() > token_data['expiry']:
+            return jsonify({"success": False, "error": "付費憑證已過期"})
+        
+        # 檢查次數
+        if token_data['uses_left'] <= 0:
+            return jsonify({"success": False, "error": "使用次數已用完"})
         
-        if not api_key:
-            return jsonify({"success": False, "error": "需要 Etherscan API Key"})
+        # 扣除使用次數
+        token_data['uses_left'] -= 1
+        token_data['used_times'].append(time.time())
+        save_payment_token(payment_token, token_data)
         
-        if not token_address or not token_address.startswith("0x") or len(token_address) != 42:
-            return jsonify({"success": False, "error": "無效的合約地址格式"})
+        # 使用付費 API Key（輪流分配）
+        api_key = get_paid_api_key()
         
-        if max_txs < 0:
-            return jsonify({"success": False, "error": "機器人閾值必須 >= 0"})
+        print(f"💰 付費用戶使用: Token {payment_token[:8]}... 剩餘 {token_data['uses_left']} 次")
+        
+    else:
+        # 免費用戶：使用自己的 API Key
+        api_key = req.api_key
+    
+    # 創建新的分析會話
+    session_id = create_analysis_session()
+    
+    try:
+        token_address = req.token_address
+        start_total_seconds = req.start_total_seconds
+        end_total_seconds = req.end_total_seconds
+        max_txs = req.max_txs
         
         # 檢查是否可以立即開始
+        position = 0
         if not can_start_analysis():
-            # 檢查排隊是否已滿
-            with queue_lock:
-                if len(analysis_queue_data) >= 5:
-                    return jsonify({
-                        "success": False,
-                        "error": "系統繁忙，排隊已滿，請稍後再試",
-                        "queue_full": True,
-                        "system_status": get_system_status()
-                    }), 503
-                
-                # 加入排隊
-                position = add_to_queue(session_id)
-                estimated_wait = position * 5  # 每個任務約5分鐘
-                
-                return jsonify({
-                    "success": True,
-                    "session_id": session_id,
-                    "status": "queued",
-                    "queue_position": position,
-                    "estimated_wait_minutes": estimated_wait,
-                    "message": f"排隊中...位置: {position}，預計等待: {estimated_wait} 分鐘",
+            # 加入排隊：任務照樣提交到線程池，由線程池按提交順序在有空位時執行
+            position = add_to_queue(session_id)
+            if position is None:
+                # 排隊已滿（檢查和加入在同一把鎖內完成，並發請求不會超出上限）
+                complete_session(session_id, 'error')
+                response = jsonify({
+                    "success": False,
+                    "error": "系統繁忙，排隊已滿，請稍後再試",
+                    "queue_full": True,
                     "system_status": get_system_status()
                 })
-        
-        # 可以立即開始，添加到活躍任務
-        add_active_task(session_id, token_address)
+                response.headers['Retry-After'] = str(QUEUE_FULL_RETRY_AFTER)
+                return response, 503
+            estimated_wait = position * 5  # 每個任務約5分鐘
+            update_session_progress(session_id, stage='排隊中', progress=0,
+                                    message=f"排隊中...位置: {position}，預計等待: {estimated_wait} 分鐘")
+        else:
+            # 可以立即開始，添加到活躍任務
+            add_active_task(session_id, token_address)
         
         print(f"🚀 準備啟動異步分析，Session ID: {session_id}")
         
         def run_analysis():
             try:
+                if position:
+                    # 排隊的任務輪到執行：從排隊移到活躍任務
+                    remove_from_queue(session_id)
+                    add_active_task(session_id, token_address)
+                
                 print(f"🔧 線程開始執行，Session ID: {session_id}")
-                result = analyzer.analyze_token(
-                    api_key, 
-                    token_address, 
-                    start_total_seconds, 
-                    end_total_seconds, 
-                    max_txs, 
-                    session_id=session_id
-                )
+                
+                # 熱門代幣常被多人同時查詢：先查快取，同一分析只讓一個任務調用 API，其他任務等它的結果
+                cache_path = get_result_cache_path(token_address, start_total_seconds, end_total_seconds, max_txs)
+                result = load_cached_result(cache_path)
+                owns_lock = False
+                if result is None:
+                    owns_lock = acquire_result_lock(cache_path, session_id)
+                if result is None and not owns_lock:
+                    # 相同的分析正在進行：持有者還活著（鎖在刷新）就一直等它寫入快取；
+                    # 持有者失敗釋放了鎖或崩潰留下殘留鎖時，由本請求接手分析
+                    update_session_progress(session_id, stage='等待中', progress=0, message='相同的分析正在進行，等待結果...')
+                    while result is None and not owns_lock:
+                        time.sleep(1)
+                        result = load_cached_result(cache_path)
+                        if result is None:
+                            owns_lock = acquire_result_lock(cache_path, session_id)
+                
+                if result is not None:
+                    print(f"⚡ 命中結果快取: {token_address}")
+                else:
+                    try:
+                        result = analyzer.analyze_token(
+                            api_key, 
+                            token_address, 
+                            start_total_seconds, 
+                            end_total_seconds, 
+                            max_txs, 
+                            session_id=session_id
+                        )
+                        if result.get('success'):
+                            save_cached_result(cache_path, result)
+                    finally:
+                        if owns_lock:
+                            release_result_lock(cache_path, session_id)
                 print(f"✅ 分析完成，準備標記 session")
                 complete_session(session_id, 'completed', result=result)
                 print(f"✅ Session 標記完成")
             except Exception as e:
                 print(f"❌ 分析錯誤: {str(e)}")
                 complete_session(session_id, 'error')
-                import traceback
-                traceback.print_exc()
+                log_exception(f'分析失敗: {session_id}')
             finally:
                 # 移除活躍任務
                 remove_active_task(session_id)
@@ -1260,8 +2345,19 @@ def api_analyze():
         analysis_executor.submit(run_analysis)
         print(f"✅ 任務已提交到線程池")
         
+        if position:
+            return json_response({
+                "success": True,
+                "session_id": session_id,
+                "status": "queued",
+                "queue_position": position,
+                "estimated_wait_minutes": estimated_wait,
+                "message": f"排隊中...位置: {position}，預計等待: {estimated_wait} 分鐘",
+                "system_status": get_system_status()
+            })
+        
         # 立即返回 session_id
-        return jsonify({
+        return json_response({
             "success": True,
             "session_id": session_id,
             "status": "processing",
@@ -1275,8 +2371,7 @@ def api_analyze():
         remove_from_queue(session_id)
         complete_session(session_id, 'error')
         
-        import traceback
-        traceback.print_exc()
+        log_exception(f'提交分析失敗: {session_id}')
         return jsonify({
             "success": False,
             "error": f"分析錯誤: {str(e)}",
@@ -1284,58 +2379,65 @@ def api_analyze():
         })
 
 
+# CSV 匯出每批寫入的行數
+CSV_EXPORT_BATCH_ROWS = 500
+
 @app.route('/api/export', methods=['POST'])
 def export_csv():
     """匯出為 CSV 文件"""
-    data = request.json
+    data = get_request_json()
     buyers = data.get('buyers', [])
     token_info = data.get('token_info', {})
     
-    # 使用 UTF-8 with BOM 編碼，讓 Excel 正確顯示中文
-    output = io.StringIO()
-    # 寫入 BOM (Byte Order Mark) 讓 Excel 識別 UTF-8
-    output.write('\ufeff')
-    
-    writer = csv.writer(output)
-    
-    # 寫入表頭
-    writer.writerow([
-        "地址",
-        "首次買入",
-        "BNB成本",
-        "BNB收益",
-        "BNB利潤",
-        "總利潤(USD)",
-        "倍數",
-        "持倉時間",
-        "狀態",
-        "買入次數",
-        "賣出次數"
-    ])
-    
-    # 寫入數據
-    for buyer in buyers:
+    def generate():
+        # 分批寫入緩衝區並立即輸出，不在記憶體中拼出整個文件；
+        # csv 直接編碼寫入 bytes 緩衝區，輸出時不必再整段 encode。
+        # utf-8-sig 在第一次寫入時自動加上 BOM，讓 Excel 識別 UTF-8，正確顯示中文
+        raw = io.BytesIO()
+        output = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='', write_through=True)
+        writer = csv.writer(output)
+        
+        # 寫入表頭
         writer.writerow([
-            buyer['address'],
-            buyer['first_buy_time'],
-            f"{buyer.get('bnb_spent', 0):.4f}",
-            f"{buyer.get('bnb_received', 0):.4f}",
-            f"{buyer.get('bnb_profit', 0):.4f}",
-            f"{buyer.get('total_profit_usd', 0):.2f}",
-            f"{buyer.get('profit_multiple', 0):.2f}",
-            buyer.get('holding_time', '-'),
-            buyer['status'],
-            buyer['buy_count'],
-            buyer['sell_count']
+            "地址",
+            "首次買入",
+            "BNB成本",
+            "BNB收益",
+            "BNB利潤",
+            "總利潤(USD)",
+            "倍數",
+            "持倉時間",
+            "狀態",
+            "買入次數",
+            "賣出次數"
         ])
-    
-    output.seek(0)
-    
-    # 獲取內容並轉換為 UTF-8 with BOM
-    csv_content = output.getvalue()
+        
+        # 寫入數據：每批用列表推導構建好所有行，一次 writerows 寫入後輸出
+        for i in range(0, len(buyers), CSV_EXPORT_BATCH_ROWS):
+            writer.writerows([
+                (
+                    buyer['address'],
+                    buyer['first_buy_time'],
+                    f"{buyer.get('bnb_spent', 0):.4f}",
+                    f"{buyer.get('bnb_received', 0):.4f}",
+                    f"{buyer.get('bnb_profit', 0):.4f}",
+                    f"{buyer.get('total_profit_usd', 0):.2f}",
+                    f"{buyer.get('profit_multiple', 0):.2f}",
+                    buyer.get('holding_time', '-'),
+                    buyer['status'],
+                    buyer['buy_count'],
+                    buyer['sell_count']
+                )
+                for buyer in buyers[i:i + CSV_EXPORT_BATCH_ROWS]
+            ])
+            yield raw.getvalue()
+            raw.seek(0)
+            raw.truncate()
+        
+        yield raw.getvalue()
     
     return Response(
-        csv_content.encode('utf-8-sig'),
+        generate(),
         mimetype="text/csv; charset=utf-8",
         headers={
             "Content-Disposition": f"attachment;filename=early_buyers_{token_info.get('symbol', 'token')}.csv",
@@ -1354,7 +2456,6 @@ if __name__ == "__main__":
     print("\n  啟動中...")
     
     # 支援雲端平台的端口配置
-    import os
     port = int(os.environ.get("PORT", 5000))
     
     if port == 5000:
@@ -1363,6 +2464,8 @@ if __name__ == "__main__":
     else:
         print(f"  運行在端口: {port}")
     
+    print("\n  ⚠️  這是 Flask 開發服務器，僅供本地使用")
+    print("  生產環境請使用: gunicorn fourmeme_etherscan:app（配置見 gunicorn.conf.py）")
     print("="*70 + "\n")
     
-    app.run(debug=False, host="0.0.0.0", port=port)
+    app.run(debug=False, host="0.0.0.0", port=port, threaded=True)
@@ -0,0 +1,23 @@
+"""
+Gunicorn 生產環境配置（gunicorn 啟動時自動讀取當前目錄下的本文件）
+
+    gunicorn fourmeme_etherscan:app
+"""
+
+import os
+
+# 綁定雲端平台提供的端口
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# 單進程多線程：分析任務的並發上限、排隊和活躍任務都在進程內管理，
+# 多個 Worker 會各自放行 MAX_CONCURRENT_ANALYSIS 個分析，超出記憶體預算。
+# 請求處理都是 I/O 等待（長輪詢、讀 session 文件），線程足以重疊這些等待
+worker_class = 'gthread'
+# 固定單進程：不讀 WEB_CONCURRENCY（雲端平台會自動設置它，會悄悄放大並發上限和每個 Key 的額度）
+workers = 1
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+
+# 長輪詢單次最多等待 15 秒，超時要留足餘量
+timeout = 120
+graceful_timeout = 30
+keepalive = 5